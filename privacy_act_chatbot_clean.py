@@ -1,114 +1,47 @@
 # Databricks notebook source
-# MAGIC %pip install transformers==4.30.2 "unstructured[pdf,docx]==0.10.30" llama-index==0.9.40 databricks-vectorsearch==0.20 pydantic==1.10.9 mlflow==2.9.0 protobuf==3.20.0 openai==1.10.0 langchain-openai langchain torch torchvision torchaudio FlagEmbedding
+# MAGIC %pip install transformers==4.30.2 "unstructured[pdf,docx]==0.10.30" llama-index==0.9.40 databricks-vectorsearch==0.20 pydantic==1.10.9 mlflow==2.9.0 protobuf==3.20.0 openai==1.10.0 tiktoken torch torchvision torchaudio
 # MAGIC dbutils.library.restartPython()
 
 # COMMAND ----------
 
-import io
-import re
-
-# DBTITLE 1,Helper function for read_from_text
-from unstructured.partition.auto import partition
-
-
-def extract_doc_text(x : bytes) -> str:
-  # Read files and extract the values with unstructured
-  sections = partition(file=io.BytesIO(x))
-  print(sections)
-  def clean_section(txt):
-    txt = re.sub(r'\n', '', txt)
-    return re.sub(r' ?\.', '.', txt)
-  # Default split is by section of document, concatenate them all together because we want to split by sentence instead.
-  return "\n".join([clean_section(s.text) for s in sections]) 
-
-# COMMAND ----------
-
-# DBTITLE 1,Databricks BGE Embedding
-import pandas as pd
-from pyspark.sql.functions import pandas_udf
+# DBTITLE 1,Pipeline setup
+# The code lives in the privacy_act_rag package next to this notebook (importable from the repo root on the
+# driver and the executors); nothing heavy is loaded until a cell needs it.
+import os
+from pprint import pprint
 
-# COMMAND ----------
+from privacy_act_rag import PrivacyActRAG, RAGConfig
+from privacy_act_rag.embeddings import ada_embed_model, azure_openai_endpoint, bge_embed_model
+from privacy_act_rag.extraction import compare_extraction_peak_rss, make_synthetic_pdf
+from privacy_act_rag.generation import pack_context
+from privacy_act_rag.ingest import (chunk_documents, collect_worker_resource_timings, embed_with_cache_table,
+                                    get_embedding_result, incremental_ingest, make_ada_embedding_udf, unpersist_all)
+from privacy_act_rag.resources import get_chunk_splitter
+from privacy_act_rag.retrieval import LocalVectorIndex, LocalVectorSearchClient
 
+azure_openai_api_key = dbutils.secrets.get(scope='dev_demo', key='azure_openai_api_key')
 
-@pandas_udf("array<float>")
-def get_embedding(contents: pd.Series) -> pd.Series:
-    import mlflow.deployments
-    deploy_client = mlflow.deployments.get_deploy_client("databricks")
-    def get_embeddings(batch):
-        #Note: this will fail if an exception is thrown during embedding creation (add try/except if needed) 
-        response = deploy_client.predict(endpoint="databricks-bge-large-en", inputs={"input": batch})
-        return [e['embedding'] for e in response.data]
+os.environ["AZURE_OPENAI_API_KEY"] = azure_openai_api_key
+os.environ["AZURE_OPENAI_ENDPOINT"] = azure_openai_endpoint
 
-    # Splitting the contents into batches of 150 items each, since the embedding model takes at most 150 inputs per request.
-    max_batch_size = 150
-    batches = [contents.iloc[i:i + max_batch_size] for i in range(0, len(contents), max_batch_size)]
+# Reduce the arrow batch size as our PDF can be big in memory
+spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", 10)
 
-    # Process each batch and collect the results
-    all_embeddings = []
-    for batch in batches:
-        all_embeddings += get_embeddings(batch.tolist())
+# Struct UDFs: chunks the endpoints keep failing on get a null embedding and a row in demo.hackathon.embedding_errors
+get_ada_embedding = make_ada_embedding_udf(azure_openai_api_key, with_errors=True)
 
-    return pd.Series(all_embeddings)
+rag = PrivacyActRAG(RAGConfig(), azure_openai_api_key=azure_openai_api_key)
 
 # COMMAND ----------
 
-import logging
-import os
-from typing import Iterator
-
-import mypy_extensions
-import pandas as pd
-from langchain_openai import AzureOpenAIEmbeddings
-from llama_index import Document, set_global_tokenizer
-# DBTITLE 1,OpenAI Client and read as chunk function defined
-from llama_index.langchain_helpers.text_splitter import SentenceSplitter
-from llama_index.node_parser import SemanticSplitterNodeParser
-from openai import AzureOpenAI
-from pyspark.sql import functions as F
-from pyspark.sql.functions import pandas_udf
-from transformers import AutoTokenizer
-
-os.environ["AZURE_OPENAI_API_KEY"] = dbutils.secrets.get(scope='dev_demo', key='azure_openai_api_key')
-os.environ["AZURE_OPENAI_ENDPOINT"] = "https://nous-ue2-openai-sbx-openai.openai.azure.com/"
-
-embeddings = AzureOpenAIEmbeddings(
-    azure_deployment="nous-ue2-openai-sbx-base-deploy-text-embedding-ada-002",
-    openai_api_version="2023-05-15",
-)
-
-client = AzureOpenAI(
-    api_key = dbutils.secrets.get(scope='dev_demo', key='azure_openai_api_key'),
-    api_version = "2023-05-15",
-    azure_endpoint = "https://nous-ue2-openai-sbx-openai.openai.azure.com/",
-    )
+# DBTITLE 1,Peak RSS: full-text vs streaming extraction
+# # Raise spark.sql.execution.arrow.maxRecordsPerBatch once the streaming path shows a comfortable margin
+# compare_extraction_peak_rss(make_synthetic_pdf(num_pages=500), get_chunk_splitter())
 
-# Reduce the arrow batch size as our PDF can be big in memory
-spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", 10)
-
-os.environ["HF_HOME"] = '/tmp'
-
-@pandas_udf("array<string>")
-def read_as_chunk(batch_iter: Iterator[pd.Series]) -> Iterator[pd.Series]:
-    #set embedding model
-    # embed_model = "nous-ue2-openai-sbx-base-deploy-text-embedding-ada-002"
-    #set llama2 as tokenizer to match our model size (will stay below BGE 1024 limit)
-    set_global_tokenizer(
-      AutoTokenizer.from_pretrained("hf-internal-testing/llama-tokenizer", cache_dir = '/tmp')
-    )
-    # splitter = SemanticSplitterNodeParser(
-    # buffer_size=1, breakpoint_percentile_threshold=95, embed_model=embeddings
-    # )
-    #Sentence splitter from llama_index to split on sentences
-    base_splitter = SentenceSplitter(chunk_size=500, chunk_overlap=25)
-    def extract_and_split(b):
-      txt = extract_doc_text(b)
-      nodes = base_splitter.get_nodes_from_documents([Document(text=txt)])
-      logging.info(f"from chunk function: {txt}")
-      
-      return [n.text for n in nodes]
+# COMMAND ----------
 
-    for x in batch_iter:
-        yield x.apply(extract_and_split)
+# DBTITLE 1,Worker startup timings
+# display(collect_worker_resource_timings())
 
 # COMMAND ----------
 
@@ -124,49 +57,15 @@ def read_as_chunk(batch_iter: Iterator[pd.Series]) -> Iterator[pd.Series]:
 
 # COMMAND ----------
 
-# DBTITLE 1,Get Embeddings function defined
-def open_ai_embeddings(contents):
-    embed_model = "nous-ue2-openai-sbx-base-deploy-text-embedding-ada-002"
-
-    response = client.embeddings.create(
-        input = contents,
-        model = embed_model
-    )
-
-    return response.data[0].embedding
-
-# COMMAND ----------
-
-import os
-
-import mypy_extensions
-import pandas as pd
-# DBTITLE 1,BGE Vector Search Client
-from databricks.vector_search.client import VectorSearchClient
-from pyspark.sql import functions as F
-
-# COMMAND ----------
-
 # DBTITLE 1,Write to databricks_pdf_documentation_openai
-# from pyspark.sql import functions as F
-# import mypy_extensions
-# import pandas as pd
-# import os
-
-# # # Reduce the arrow batch size as our PDF can be big in memory
-# # spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", 10)
-
-# # os.environ["HF_HOME"] = '/tmp'
-
 # volume_folder = f"/Volumes/demo/hackathon/privacy_act_docs/*"
 
 # # ADA Embeddings
-# temp = (spark.table('demo.hackathon.pdf_raw')
-#         .withColumn("content", F.explode(read_as_chunk("content")))
-#         .withColumn("ada_embedding", F.lit(open_ai_embeddings("content")))
-#         .withColumn("id", F.monotonically_increasing_id())
-#         .withColumn("state", F.split(F.col("path"), "/")[5])
-#         .selectExpr('id', 'path as url', 'content', 'ada_embedding', 'state')
+# persisted = []
+# temp = chunk_documents(spark.table('demo.hackathon.pdf_raw'), persisted=persisted)
+# temp = (embed_with_cache_table(temp, ada_embed_model, get_ada_embedding, "ada_embedding", persisted=persisted)
+#         .where("ada_embedding IS NOT NULL")
+#         .selectExpr('id', 'url', 'content', 'ada_embedding', 'state')
 #         )
 
 # (temp.write
@@ -174,14 +73,14 @@ from pyspark.sql import functions as F
 #     .option("overwriteSchema", "true")
 #     .mode("overwrite")
 #     .saveAsTable('demo.hackathon.databricks_pdf_documentation_openai'))
+# unpersist_all(persisted)
 
 # # BGE Embeddings
-# temp = (spark.table('demo.hackathon.pdf_raw')
-#         .withColumn("content", F.explode(read_as_chunk("content")))
-#         .withColumn("bge_embedding", F.lit(get_embedding("content")))
-#         .withColumn("id", F.monotonically_increasing_id())
-#         .withColumn("state", F.split(F.col("path"), "/")[5])
-#         .selectExpr('id', 'path as url', 'content', 'bge_embedding', 'state')
+# persisted = []
+# temp = chunk_documents(spark.table('demo.hackathon.pdf_raw'), persisted=persisted)
+# temp = (embed_with_cache_table(temp, bge_embed_model, get_embedding_result, "bge_embedding", persisted=persisted)
+#         .where("bge_embedding IS NOT NULL")
+#         .selectExpr('id', 'url', 'content', 'bge_embedding', 'state')
 #         )
 
 # (temp.write
@@ -189,47 +88,15 @@ from pyspark.sql import functions as F
 #     .option("overwriteSchema", "true")
 #     .mode("overwrite")
 #     .saveAsTable('demo.hackathon.databricks_pdf_documentation_baai'))
+# unpersist_all(persisted)
 
 # COMMAND ----------
 
 # %sql
+# -- Near-duplicates are dropped while chunking (ingest.chunk_documents), both counts should match
 # use catalog `demo`; 
 # select count(*), count(distinct content) from `hackathon`.`databricks_pdf_documentation_baai` 
 
-
-
-# COMMAND ----------
-
-# table = spark.table('demo.hackathon.databricks_pdf_documentation_baai')
-# table = table.dropDuplicates(subset=["content"])
-
-# (table.write
-#     .option("overwriteSchema", "true")
-#     .mode("overwrite")
-#     .saveAsTable('demo.hackathon.databricks_pdf_documentation_baai'))
-
-# COMMAND ----------
-
-# %sql
-# use catalog `demo`; 
-# select count(*), count(distinct content) from `hackathon`.`databricks_pdf_documentation_baai` 
-
-# COMMAND ----------
-
-# %sql
-# use catalog `demo`; 
-# select count(*), count(distinct content) from `hackathon`.`databricks_pdf_documentation_openai` 
-
-# COMMAND ----------
-
-# table = spark.table('demo.hackathon.databricks_pdf_documentation_openai')
-# table = table.dropDuplicates(subset=["content"])
-
-# (table.write
-#     .option("overwriteSchema", "true")
-#     .mode("overwrite")
-#     .saveAsTable('demo.hackathon.databricks_pdf_documentation_openai'))
-
 # COMMAND ----------
 
 # %sql
@@ -249,12 +116,14 @@ from pyspark.sql import functions as F
 #     .option("overwriteSchema", "true")
 #     .mode("overwrite")
 #     .saveAsTable('demo.hackathon.databricks_pdf_documentation_openai'))
+# unpersist_all(persisted)
 
 # COMMAND ----------
 
-vsc_bge = VectorSearchClient(disable_notice=True)
-vs_index_fullname_bge = "demo.hackathon.bge_self_managed_index"
-endpoint_name_bge = "bge_vector_search"
+# DBTITLE 1,BGE Vector Search Client
+vsc_bge = rag.vsc_bge
+vs_index_fullname_bge = rag.config.bge_index_name
+endpoint_name_bge = rag.config.bge_endpoint_name
 
 # COMMAND ----------
 
@@ -278,11 +147,9 @@ endpoint_name_bge = "bge_vector_search"
 # COMMAND ----------
 
 # DBTITLE 1,ADA Vector Search Client
-from databricks.vector_search.client import VectorSearchClient
-
-vsc_ada = VectorSearchClient(disable_notice=True)
-vs_index_fullname_ada = "demo.hackathon.ada_self_managed_index"
-endpoint_name_ada = "ada_vector_search"
+vsc_ada = rag.vsc_ada
+vs_index_fullname_ada = rag.config.ada_index_name
+endpoint_name_ada = rag.config.ada_endpoint_name
 
 # COMMAND ----------
 
@@ -299,6 +166,33 @@ endpoint_name_ada = "ada_vector_search"
 
 # COMMAND ----------
 
+# DBTITLE 1,Local vector index (offline drop-in for vector search)
+# # Serve retrieval from local indexes (offline runs, benchmarks) instead of the vector search endpoints
+# rag = PrivacyActRAG(
+#     RAGConfig(), azure_openai_api_key=azure_openai_api_key,
+#     vsc_bge=LocalVectorSearchClient({vs_index_fullname_bge: LocalVectorIndex.from_table('demo.hackathon.databricks_pdf_documentation_baai', "bge_embedding")}),
+#     vsc_ada=LocalVectorSearchClient({vs_index_fullname_ada: LocalVectorIndex.from_table('demo.hackathon.databricks_pdf_documentation_openai', "ada_embedding")}))
+
+# COMMAND ----------
+
+# DBTITLE 1,Compact int8 embeddings (4x smaller scans, full-precision re-scoring)
+# # int8 codes + a float32 scale per vector in a BINARY column next to the ARRAY<FLOAT> one (vector search keeps
+# # syncing from the latter). The local index scans the codes and re-scores its top candidates from a memmapped copy.
+# from privacy_act_rag.ingest import compact_embeddings
+# from privacy_act_rag.retrieval import recall_at_k
+# (compact_embeddings(spark.table('demo.hackathon.databricks_pdf_documentation_baai'), "bge_embedding", "int8")
+#     .write.mode("overwrite").saveAsTable('demo.hackathon.databricks_pdf_documentation_baai_int8'))
+# bge_full = LocalVectorIndex.from_table('demo.hackathon.databricks_pdf_documentation_baai', "bge_embedding")
+# bge_int8 = LocalVectorIndex.from_table('demo.hackathon.databricks_pdf_documentation_baai_int8', "bge_embedding",
+#                                        dtype="int8", quantized_col="bge_embedding_int8", keep_full=True)
+# bge_int8.save("/local_disk0/tmp/bge_int8_index")
+# bge_int8 = LocalVectorIndex.load("/local_disk0/tmp/bge_int8_index")
+# sample_queries = ["What rights can consumers exercise?", "What is considered biometric data?",
+#                   "When does the Colorado Privacy Act take effect?"]
+# pprint(recall_at_k(bge_full, bge_int8, [rag.embed_bge(q) for q in sample_queries], k=10))
+
+# COMMAND ----------
+
 # DBTITLE 1,Resync BGE Embeddings
 # # Resync our index with new data
 # vsc_bge.get_index(endpoint_name_bge, vs_index_fullname_bge).sync()
@@ -311,101 +205,29 @@ endpoint_name_ada = "ada_vector_search"
 
 # COMMAND ----------
 
-import ast
-
-import mlflow.deployments
-
-
-def get_state_from_query(query):
-    client = mlflow.deployments.get_deploy_client("databricks")
-    inputs = {
-        "messages": [
-            {
-                "role": "user",
-                "content": f"""
-                You determine if there are any US states present in this text: {query}.
-                Your response should be JSON like the following:
-                {{ 
-                    "state": []
-                }}
-
-                """
-            }
-        ],
-        "max_tokens": 64,
-        "temperature": 0
-    }
-
-    response = client.predict(endpoint="databricks-mixtral-8x7b-instruct", inputs=inputs)
-    return response["choices"][0]['message']['content']
+# DBTITLE 1,Incremental refresh (new or changed PDFs only)
+# # The BM25 index is rebuilt from the BGE chunk table along with the vector index sync
+# from privacy_act_rag.lexical import build_lexical_index
+# def sync_bge():
+#     vsc_bge.get_index(endpoint_name_bge, vs_index_fullname_bge).sync()
+#     build_lexical_index('demo.hackathon.databricks_pdf_documentation_baai', rag.config.lexical_index_path)
+# incremental_ingest('demo.hackathon.databricks_pdf_documentation_baai', "bge_embedding", bge_embed_model, get_embedding_result,
+#                    sync_index=sync_bge)
+# incremental_ingest('demo.hackathon.databricks_pdf_documentation_openai', "ada_embedding", ada_embed_model, get_ada_embedding,
+#                    sync_index=lambda: vsc_ada.get_index(endpoint_name_ada, vs_index_fullname_ada).sync())
 
 # COMMAND ----------
 
-# DBTITLE 1,Test prompts (call embedding endpoint here)
+# DBTITLE 1,Warm up (models, clients, indexes)
+print(f"Warm-up: {rag.warm_up():.1f}s")
+pprint(rag.component_timings)
 
-# from mlflow.deployments import get_deploy_client
-from pprint import pprint
-
-# bge-large-en Foundation models are available using the /serving-endpoints/databricks-bge-large-en/invocations api. 
-# deploy_client = get_deploy_client("databricks")
+# COMMAND ----------
 
+# DBTITLE 1,Test prompts
 query = f"What rights can consumers exercise?"
 # What is considered biometric data?
-response = get_state_from_query(query)
-cleaned_response = response.replace("```json", "")
-cleaned_response = cleaned_response.replace("```", "")
-filters = ast.literal_eval(cleaned_response)
-
-# COMMAND ----------
-
-# ADA embedding search
-if filters["state"] != []:
-  results_ada = vsc_ada.get_index(endpoint_name_ada, vs_index_fullname_ada).similarity_search(
-    query_vector = open_ai_embeddings(query),
-    columns=["id","state", "url", "content"],
-    filters=filters,
-    num_results=10)
-  docs_ada = results_ada.get('result', {}).get('data_array', [])
-  pprint(docs_ada)
-else:
-  results_ada = vsc_ada.get_index(endpoint_name_ada, vs_index_fullname_ada).similarity_search(
-    query_vector = open_ai_embeddings(query),
-    columns=["id","state", "url", "content"],
-    num_results=10)
-  docs_ada = results_ada.get('result', {}).get('data_array', [])
-  pprint(docs_ada)
-
-# COMMAND ----------
-
-# Ad-hoc BGE embedding function
-import mlflow.deployments
-
-bge_deploy_client = mlflow.deployments.get_deploy_client("databricks")
-
-def get_bge_embeddings(query):
-    #Note: this will fail if an exception is thrown during embedding creation (add try/except if needed) 
-    response = bge_deploy_client.predict(endpoint="databricks-bge-large-en", inputs={"input": query})
-    #return [e['embedding'] for e in response.data]
-    return response.data[0]['embedding']
-
-# COMMAND ----------
-
-# BGE embedding search
-if filters["state"] != []:
-  results_bge = vsc_bge.get_index(endpoint_name_bge, vs_index_fullname_bge).similarity_search(
-    query_vector = get_bge_embeddings(query),
-    columns=["id","state", "url", "content"],
-    filters=filters,
-    num_results=10)
-  docs_bge = results_bge.get('result', {}).get('data_array', [])
-  pprint(docs_bge)
-else:
-  results_bge = vsc_bge.get_index(endpoint_name_bge, vs_index_fullname_bge).similarity_search(
-    query_vector = get_bge_embeddings(query),
-    columns=["id","state", "url", "content"],
-    num_results=10)
-  docs_bge = results_bge.get('result', {}).get('data_array', [])
-  pprint(docs_bge)
+filters = rag.detect_states(query)
 
 # COMMAND ----------
 
@@ -428,62 +250,100 @@ else:
 
 # COMMAND ----------
 
-docs = docs_bge + docs_ada
-dedup_docs = list(set(tuple(i) for i in docs))
-final_list = [list(i) for i in dedup_docs]
+# DBTITLE 1,Concurrent BGE + ADA + BM25 retrieval with reciprocal-rank fusion
+retrieved = rag.retriever.retrieve(query, filters)
+final_list = retrieved["docs"]
 
+pprint(retrieved["timings"])
 print(final_list)
-# print(len(docs_bge), len(docs_ada) , len(dedup_docs))
 
 
 # COMMAND ----------
 
-from FlagEmbedding import FlagReranker
 # DBTITLE 1,Reranking with bge-reranker-large
-# Load model directly
-from transformers import AutoModelForSequenceClassification, AutoTokenizer
+reranked_docs = rag.reranker.rerank(query, final_list, max_candidates=rag.config.rerank_candidates)
 
-tokenizer = AutoTokenizer.from_pretrained("BAAI/bge-reranker-large")
-model = AutoModelForSequenceClassification.from_pretrained("BAAI/bge-reranker-large")
+pprint(reranked_docs)
 
-reranker = FlagReranker('BAAI/bge-reranker-large', use_fp16=True) # Setting use_fp16 to True speeds up computation with a slight performance degradation
+# COMMAND ----------
 
-query_and_docs = [[query, d[1]] for d in final_list]
+#reranked_docs[0][0][3].replace("\n"," ")
 
-scores = reranker.compute_score(query_and_docs)
+# COMMAND ----------
 
-reranked_docs = sorted(list(zip(final_list, scores)), key=lambda x: x[1], reverse=True)
+# DBTITLE 1,Streaming Mixtral generation
+userquery = '''Summarize this result: '''
+generator = rag.generator
 
-pprint(reranked_docs)
+def mixtral_query(userquery, packed=None):
+    # Returns an iterator over the generated text
+    packed = pack_context(reranked_docs, rag.config.context_token_budget) if packed is None else packed
+    return generator.stream(f"{userquery}\n\n{packed['context']}", context_ids=[d[0] for d in packed["docs"]])
 
 # COMMAND ----------
 
-#reranked_docs[0][0][3].replace("\n"," ")
+packed = pack_context(reranked_docs, rag.config.context_token_budget)
+
+# print LLM output as it is generated
+for token in mixtral_query(userquery, packed):
+    print(token, end="")
 
 # COMMAND ----------
 
-userquery = '''Summarize this result: '''
+print(f"Time to first token: {generator.last_stats.get('ttft_s', 0):.2f}s",
+f"\nContext: {packed['tokens']} tokens from {len(packed['docs'])} chunks")
+for d in packed["docs"]:
+    print(f"\nDocument from State: {d[1]}",
+    f"\nResult id: {d[0]}",
+    f"\nDocument path: {d[2]}"
+    )
 
-def mixtral_query(userquery):
-    client = mlflow.deployments.get_deploy_client("databricks")
-    inputs = {
-        "messages": [{"role":"user","content":f"{userquery} {reranked_docs[0][0][3]}"}],
-        "max_tokens": 1500,
-        "temperature": 0.8
-    }
+# COMMAND ----------
+
+# DBTITLE 1,End-to-end answer
+# # Invalidate right after an ingest/sync instead of waiting for the next version check
+# from privacy_act_rag.answer_cache import current_index_version
+# rag.answer_cache.set_index_version(current_index_version())
+pprint(rag.answer("when does the Colorado act take effect"))
+pprint(rag.metrics())
+
+# COMMAND ----------
+
+# DBTITLE 1,Tracing (spans, counters, histograms)
+# # Driver side: spans go to a JSONL file per process, the summaries to the active MLflow run.
+# # Executors trace when the cluster sets PRIVACY_ACT_RAG_TRACE (spark.executorEnv.PRIVACY_ACT_RAG_TRACE 1).
+# from privacy_act_rag import tracing
+# from privacy_act_rag.ingest import collect_trace_metrics
+# tracing.enable_tracing("/local_disk0/tmp/privacy_act_rag_trace/{pid}.jsonl")
+# rag.answer("What rights can consumers exercise in Colorado?")
+# pprint(tracing.snapshot())
+# tracing.log_to_mlflow(prefix="query.")
+# display(collect_trace_metrics())
+
+# COMMAND ----------
 
-    response = client.predict(endpoint="databricks-mixtral-8x7b-instruct", inputs=inputs)
-    return response["choices"][0]['message']['content']
+# DBTITLE 1,Offline benchmark (local stand-ins for every endpoint)
+# # Stage latencies (p50/p95/p99) and throughput as JSON; keep the report to compare later runs against
+# from privacy_act_rag.benchmark import compare_reports, run_benchmark
+# bench = run_benchmark(num_docs=8, num_pages=50, num_queries=200)
+# pprint({stage: (s["p50_s"], s["p95_s"], s["throughput_per_s"]) for stage, s in bench["stages"].items()})
 
 # COMMAND ----------
 
-print(mixtral_query(userquery))
+# DBTITLE 1,Batch evaluation (DataFrame or JSONL of queries)
+# # Stage by stage over the whole set (bulk embeddings, cross-query reranking, concurrent generation); one row per
+# # query with its per-stage timings lands in demo.hackathon.batch_answers
+# from privacy_act_rag.batch import batch_results_table, run_batch
+# eval_queries = spark.createDataFrame([("q1", "What rights can consumers exercise in Colorado?"),
+#                                       ("q2", "What is considered biometric data?")], "query_id string, query string")
+# summary = run_batch(rag, eval_queries, output_table=batch_results_table)
+# pprint(summary)
+# display(spark.table(batch_results_table).where(f"run_id = '{summary['run_id']}'"))
 
 # COMMAND ----------
 
-# print LLM output
-print(mixtral_query(userquery), 
-f"\n\nDocument from State: {reranked_docs[0][0][1]}",
-f"\nResult id: {reranked_docs[0][0][0]}",
-f"\nDocument path: {reranked_docs[0][0][2]}"
-)
+# DBTITLE 1,Query server
+# # Same pipeline behind HTTP (POST /answer, POST /answer_batch, GET /healthz, GET /metrics), e.g. from a job:
+# #   python -m privacy_act_rag.server --port 8000
+# from privacy_act_rag.server import serve
+# serve(rag, port=8000, warm_up=False)
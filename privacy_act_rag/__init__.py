@@ -0,0 +1,2 @@
+# Importing the package is cheap: models, clients and indexes are only built when a pipeline first needs them
+from privacy_act_rag.pipeline import PrivacyActRAG, RAGConfig
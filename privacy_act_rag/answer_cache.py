@@ -0,0 +1,92 @@
+# Semantic cache of end-to-end answers, keyed on the query embedding
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SemanticAnswerCache:
+    # Answers keyed on the query embedding: a query reuses a cached answer when its cosine similarity with a
+    # cached query of the same state scope reaches threshold. LRU + TTL eviction, and everything is dropped when
+    # version_fn (checked at most every version_check_s) reports a new index version.
+    def __init__(self, threshold=0.95, max_entries=1024, ttl_s=24 * 3600, version_fn=None, version_check_s=300):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.version_fn = version_fn
+        self.version_check_s = version_check_s
+        self.index_version = None
+        self.version_checked_at = None
+        self.entries = OrderedDict()
+        self.keys = itertools.count()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "latency_saved_s": 0.0, "invalidations": 0}
+
+    @staticmethod
+    def scope(filters):
+        return tuple(sorted((filters or {}).get("state") or []))
+
+    def set_index_version(self, version):
+        with self.lock:
+            if version != self.index_version:
+                if self.index_version is not None:
+                    self.stats["invalidations"] += 1
+                self.entries.clear()
+                self.index_version = version
+
+    def _check_version(self):
+        now = time.monotonic()
+        if self.version_fn is not None and (self.version_checked_at is None or now - self.version_checked_at > self.version_check_s):
+            self.version_checked_at = now
+            self.set_index_version(self.version_fn())
+
+    def lookup(self, query_vector, filters):
+        start = time.perf_counter()
+        self._check_version()
+        q = np.asarray(query_vector, dtype=np.float32)
+        q /= np.linalg.norm(q) or 1
+        scope, now = self.scope(filters), time.monotonic()
+        with self.lock:
+            best, best_sim = None, self.threshold
+            for key, entry in list(self.entries.items()):
+                if now - entry["created"] > self.ttl_s:
+                    del self.entries[key]
+                elif entry["scope"] == scope:
+                    sim = float(entry["vector"] @ q)
+                    if sim >= best_sim:
+                        best, best_sim = key, sim
+            if best is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(best)
+            entry = self.entries[best]
+            self.stats["hits"] += 1
+            self.stats["latency_saved_s"] += max(entry["latency_s"] - (time.perf_counter() - start), 0.0)
+            return entry["answer"]
+
+    def put(self, query_vector, filters, answer, latency_s):
+        self._check_version()
+        q = np.asarray(query_vector, dtype=np.float32)
+        q /= np.linalg.norm(q) or 1
+        with self.lock:
+            self.entries[next(self.keys)] = {
+                "scope": self.scope(filters), "vector": q, "answer": answer,
+                "latency_s": latency_s, "created": time.monotonic(),
+            }
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {**self.stats, "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+                    "entries": len(self.entries), "index_version": self.index_version}
+
+
+def current_index_version(tables=('demo.hackathon.databricks_pdf_documentation_baai', 'demo.hackathon.databricks_pdf_documentation_openai'), spark=None):
+    # The delta-sync indexes follow their source tables, so the table versions identify what the indexes serve
+    from pyspark.sql import SparkSession
+    spark = spark or SparkSession.getActiveSession()
+    return tuple(spark.sql(f"DESCRIBE HISTORY {t} LIMIT 1").collect()[0]["version"] for t in tables)
@@ -0,0 +1,89 @@
+# Batch query mode for evaluation sets and bulk Q&A: queries from a JSONL file or a DataFrame go through
+# PrivacyActRAG.answer_batch a slice at a time, and one row per query (answer, documents, error, per-stage
+# timings) is appended to a Delta table and/or a JSONL file.
+#   python -m privacy_act_rag.batch questions.jsonl --output answers.jsonl
+import argparse
+import json
+import time
+import uuid
+
+import numpy as np
+
+from privacy_act_rag.pipeline import PrivacyActRAG
+
+batch_results_table = "demo.hackathon.batch_answers"
+batch_results_schema = """run_id STRING, query_id STRING, query STRING, answer STRING, states ARRAY<STRING>,
+    doc_ids ARRAY<STRING>, doc_urls ARRAY<STRING>, context_tokens INT, cached BOOLEAN, error STRING,
+    latency_s DOUBLE, timings MAP<STRING, DOUBLE>"""
+
+
+def read_queries(source, query_col="query", id_col="query_id"):
+    # (query id, query) pairs from a JSONL path, a Spark or pandas DataFrame, or a list of strings / dicts.
+    # Rows without an id are numbered in input order.
+    if isinstance(source, str):
+        with open(source) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    elif hasattr(source, "toPandas"):
+        records = source.select(*[c for c in (id_col, query_col) if c in source.columns]).toPandas().to_dict("records")
+    elif hasattr(source, "to_dict"):
+        records = source.to_dict("records")
+    else:
+        records = [r if isinstance(r, dict) else {query_col: r} for r in source]
+    return [(str(r[id_col]) if r.get(id_col) is not None else str(i), r[query_col]) for i, r in enumerate(records)]
+
+
+def result_row(run_id, query_id, result):
+    return {"run_id": run_id, "query_id": query_id, "query": result["query"], "answer": result["answer"],
+            "states": list((result.get("filters") or {}).get("state") or []),
+            "doc_ids": [str(d[0]) for d in result["docs"]], "doc_urls": [d[2] for d in result["docs"]],
+            "context_tokens": result["context_tokens"], "cached": result["cached"], "error": result.get("error"),
+            "latency_s": result["latency_s"], "timings": result["timings"]}
+
+
+def summarize(rows, wall_s):
+    stages = {}
+    for row in rows:
+        for stage, seconds in row["timings"].items():
+            stages.setdefault(stage, []).append(seconds)
+    return {"queries": len(rows), "failed": sum(r["error"] is not None for r in rows),
+            "cached": sum(r["cached"] for r in rows), "wall_s": wall_s,
+            "queries_per_s": len(rows) / wall_s if wall_s else None,
+            "stages": {stage: {"p50_s": float(np.percentile(v, 50)), "p95_s": float(np.percentile(v, 95)),
+                               "total_s": float(np.sum(v))} for stage, v in stages.items()}}
+
+
+def run_batch(rag, source, output_table=None, output_path=None, run_id=None, slice_size=500, spark=None,
+              query_col="query", id_col="query_id"):
+    # slice_size bounds the queries (and their retrieved documents) held in memory; each slice is written
+    # before the next one starts, so a long run keeps what it finished if it is interrupted
+    run_id = run_id or uuid.uuid4().hex
+    queries = read_queries(source, query_col, id_col)
+    if output_table is not None and spark is None:
+        from pyspark.sql import SparkSession
+        spark = SparkSession.getActiveSession()
+    rows, start = [], time.perf_counter()
+    for n in range(0, len(queries), slice_size):
+        part = queries[n:n + slice_size]
+        part_rows = [result_row(run_id, query_id, result)
+                     for (query_id, _), result in zip(part, rag.answer_batch([q for _, q in part]))]
+        if output_table is not None:
+            spark.sql(f"CREATE TABLE IF NOT EXISTS {output_table} ({batch_results_schema})")
+            (spark.createDataFrame([tuple(r.values()) for r in part_rows], batch_results_schema)
+                .write.mode("append").saveAsTable(output_table))
+        if output_path is not None:
+            with open(output_path, "a") as f:
+                f.writelines(json.dumps(r, default=str) + "\n" for r in part_rows)
+        rows += part_rows
+    return {"run_id": run_id, **summarize(rows, time.perf_counter() - start)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("queries", help="JSONL file with a query field (and optionally query_id) per line")
+    parser.add_argument("--output", help="JSONL file the results are appended to")
+    parser.add_argument("--table", help="Delta table the results are appended to (needs an active Spark session)")
+    parser.add_argument("--slice-size", type=int, default=500)
+    args = parser.parse_args()
+    summary = run_batch(PrivacyActRAG(), args.queries, output_table=args.table, output_path=args.output,
+                        slice_size=args.slice_size)
+    print(json.dumps(summary, indent=2))
@@ -0,0 +1,363 @@
+# Offline benchmark of the pipeline stages. Every remote endpoint (BGE / ADA embeddings, vector search, the chat
+# endpoint, optionally the reranker) is replaced by a deterministic local stand-in, so runs on a plain Linux box
+# can be compared with each other. The local work (PDF parsing, splitting, caches, index search, fusion,
+# packing) is the real code.
+#   python -m privacy_act_rag.benchmark --docs 8 --pages 50 --queries 200 --output bench.json
+#   python -m privacy_act_rag.benchmark --baseline bench.json
+import argparse
+import hashlib
+import heapq
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from privacy_act_rag import tracing
+from privacy_act_rag.dispatch import EmbeddingDispatcher
+from privacy_act_rag.embeddings import (EmbeddingCache, ada_embed_model, ada_max_batch_size, ada_max_batch_tokens,
+                                        ada_max_concurrency, bge_embed_model, bge_max_batch_size, bge_max_concurrency)
+from privacy_act_rag.extraction import extract_doc_text, make_synthetic_pdf
+from privacy_act_rag.generation import pack_context
+from privacy_act_rag.lexical import BM25Index
+from privacy_act_rag.pipeline import PrivacyActRAG, RAGConfig
+from privacy_act_rag.resources import restored_worker_resources, set_worker_resource
+from privacy_act_rag.retrieval import LocalVectorIndex, LocalVectorSearchClient, recall_at_k, reciprocal_rank_fusion
+
+benchmark_states = ("Colorado", "Virginia", "Connecticut", "Utah", "Texas", "Oregon", "Montana", "Iowa")
+query_templates = (
+    "What rights can consumers exercise in {state}?",
+    "When does the {state} privacy act take effect?",
+    "What is considered biometric data under the {state} law?",
+    "Does the {state} act apply to nonprofits?",
+    "What rights can consumers exercise?",
+    "What is considered biometric data?",
+)
+
+
+def fake_vector(text, dim):
+    # Same text, same unit vector, in every process and every run
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    v = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return (v / np.linalg.norm(v)).tolist()
+
+
+class FakeDeployClient:
+    # Stands in for the mlflow deploy client. Embedding endpoints return hash-seeded vectors, chat endpoints
+    # (the state detection fallback) an empty state list. Each call sleeps latency_s plus per_input_s per input.
+    def __init__(self, dim=1024, latency_s=0.0, per_input_s=0.0):
+        self.dim = dim
+        self.latency_s = latency_s
+        self.per_input_s = per_input_s
+        self.calls = 0
+
+    def predict(self, endpoint, inputs):
+        self.calls += 1
+        if "messages" in inputs:
+            time.sleep(self.latency_s)
+            return {"choices": [{"message": {"content": json.dumps({"state": []})}}]}
+        texts = inputs["input"]
+        time.sleep(self.latency_s + self.per_input_s * len(texts))
+        return SimpleNamespace(data=[{"embedding": fake_vector(t, self.dim)} for t in texts])
+
+
+class FakeAdaClient:
+    # Stands in for AzureOpenAI: client.embeddings.create(input=[...], model=...) with indexed response items
+    def __init__(self, dim=1536, latency_s=0.0, per_input_s=0.0):
+        self.dim = dim
+        self.latency_s = latency_s
+        self.per_input_s = per_input_s
+        self.embeddings = self
+        self.calls = 0
+
+    def create(self, input, model):
+        self.calls += 1
+        time.sleep(self.latency_s + self.per_input_s * len(input))
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=fake_vector(t, self.dim)) for i, t in enumerate(input)])
+
+
+class FakeReranker:
+    # Same rerank() contract as BGEReranker; scores are word overlap and each scored pair costs per_pair_s.
+    # Like the one cross-encoder of BGEReranker, pairs are scored one caller at a time.
+    def __init__(self, per_pair_s=0.0):
+        self.per_pair_s = per_pair_s
+        self.lock = threading.Lock()
+
+    def load(self):
+        return self
+
+    def rerank(self, query, docs, top_k=None, max_candidates=None, id_index=0, content_index=3):
+        candidates = docs[:max_candidates] if max_candidates else list(docs)
+        with self.lock:
+            time.sleep(self.per_pair_s * len(candidates))
+        words = set(query.lower().split())
+        scored = [(d, len(words & set(str(d[content_index]).lower().split())) / (len(words) or 1)) for d in candidates]
+        return heapq.nlargest(top_k or len(scored), scored, key=lambda x: x[1])
+
+    def rerank_many(self, queries, docs_lists, top_k=None, max_candidates=None, id_index=0, content_index=3):
+        return [self.rerank(q, docs, top_k, max_candidates, id_index, content_index) for q, docs in zip(queries, docs_lists)]
+
+
+class FakeGenerator:
+    # Same stream()/generate() contract as MixtralGenerator: ttft_s before the first token, then
+    # per_token_s for each of num_tokens tokens
+    def __init__(self, ttft_s=0.0, per_token_s=0.0, num_tokens=200):
+        self.ttft_s = ttft_s
+        self.per_token_s = per_token_s
+        self.num_tokens = num_tokens
+        self.last_stats = {}
+
+    def stream(self, prompt, context_ids=(), max_tokens=1500, temperature=0.8, stats=None):
+        stats = {} if stats is None else stats
+        self.last_stats = stats
+        start = time.perf_counter()
+        time.sleep(self.ttft_s)
+        for i in range(min(self.num_tokens, max_tokens)):
+            if i:
+                time.sleep(self.per_token_s)
+            else:
+                stats["ttft_s"] = time.perf_counter() - start
+            yield f"token{i} "
+        stats.update(total_s=time.perf_counter() - start, cached=False)
+
+    def generate(self, prompt, context_ids=(), **params):
+        return "".join(self.stream(prompt, context_ids, **params))
+
+
+def make_synthetic_corpus(num_docs=8, num_pages=50, states=benchmark_states, seed=0):
+    # (path, pdf bytes) pairs laid out like the volume, so the state is the 6th path component
+    return [(f"dbfs:/Volumes/demo/hackathon/privacy_act_docs/{states[i % len(states)]}/synthetic_{i}.pdf",
+             make_synthetic_pdf(num_pages=num_pages, seed=seed + i))
+            for i in range(num_docs)]
+
+
+def make_queries(num_queries=100, states=benchmark_states, seed=0):
+    rng = random.Random(seed)
+    return [rng.choice(query_templates).format(state=rng.choice(states)) for _ in range(num_queries)]
+
+
+class StageTimer:
+    # Wall-clock samples per stage; items is what the stage processed in that call (docs, chunks, queries)
+    def __init__(self):
+        self.samples = {}
+
+    def record(self, stage, seconds, items=1):
+        self.samples.setdefault(stage, []).append((seconds, items))
+
+    @contextmanager
+    def time(self, stage, items=1):
+        start = time.perf_counter()
+        yield
+        self.record(stage, time.perf_counter() - start, items)
+
+    def summary(self):
+        report = {}
+        for stage, samples in self.samples.items():
+            seconds = np.array([s for s, _ in samples])
+            items = sum(n for _, n in samples)
+            p50, p95, p99 = np.percentile(seconds, [50, 95, 99])
+            report[stage] = {
+                "calls": len(samples), "items": items, "total_s": float(seconds.sum()),
+                "mean_s": float(seconds.mean()), "p50_s": float(p50), "p95_s": float(p95), "p99_s": float(p99),
+                "max_s": float(seconds.max()),
+                "throughput_per_s": items / float(seconds.sum()) if seconds.sum() else None,
+            }
+        return report
+
+
+def run_benchmark(num_docs=8, num_pages=50, num_queries=100, embed_latency_s=0.02, embed_per_input_s=0.0005,
+                  chat_ttft_s=0.3, chat_per_token_s=0.01, chat_tokens=200, rerank_per_pair_s=0.005,
+                  real_reranker=False, doc_batch_size=10, embed_batch_size=1000, rate_limits=False, index_dtype="float32",
+                  lexical=True, seed=0, workdir=None):
+    from privacy_act_rag.ingest import get_embedding, make_ada_embedding_udf, read_as_chunk
+
+    # Every stand-in below is registered process-wide; the registry is restored afterwards so the notebook
+    # cells or the server sharing this process keep their real clients, rate limits and embedding cache.
+    # A workdir created here is removed with its caches.
+    owns_workdir = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="rag_benchmark_")
+    caches = []
+    try:
+        with restored_worker_resources():
+            timer = StageTimer()
+            deploy_client = FakeDeployClient(1024, embed_latency_s, embed_per_input_s)
+            ada_client = FakeAdaClient(1536, embed_latency_s, embed_per_input_s)
+            set_worker_resource("deploy_client", deploy_client)
+            set_worker_resource("ada_client", ada_client)
+            if not rate_limits:
+                # The stand-ins have no quota: measure the pipeline, not the client-side token buckets
+                set_worker_resource("bge_dispatcher",
+                                    EmbeddingDispatcher(bge_embed_model, bge_max_batch_size, bge_max_concurrency))
+                set_worker_resource("ada_dispatcher",
+                                    EmbeddingDispatcher(ada_embed_model, ada_max_batch_size, ada_max_concurrency,
+                                                        max_batch_units=ada_max_batch_tokens))
+            # Start from an empty embedding cache so the first pass measures the endpoint path
+            caches.append(EmbeddingCache(os.path.join(workdir, "ingest_cache.sqlite")))
+            set_worker_resource("embedding_cache", caches[-1])
+
+            corpus = make_synthetic_corpus(num_docs, num_pages, seed=seed)
+            for _, pdf in corpus:
+                with timer.time("extract_doc_text"):
+                    extract_doc_text(pdf)
+
+            # The UDF bodies run as-is (.func), in Arrow-sized batches of documents
+            chunks = []
+            for i in range(0, len(corpus), doc_batch_size):
+                batch = corpus[i:i + doc_batch_size]
+                with timer.time("read_as_chunk", items=len(batch)):
+                    for result in read_as_chunk.func(iter([pd.Series([pdf for _, pdf in batch])])):
+                        chunks += [(path, c) for (path, _), doc_chunks in zip(batch, result) for c in doc_chunks]
+            contents = [c for _, c in chunks]
+
+            get_ada_embedding = make_ada_embedding_udf("benchmark")
+            embeddings = {"bge": [], "ada": []}
+            for name, udf in (("bge", get_embedding), ("ada", get_ada_embedding)):
+                stage = "get_embedding" if name == "bge" else "get_ada_embedding"
+                for i in range(0, len(contents), embed_batch_size):
+                    batch = pd.Series(contents[i:i + embed_batch_size])
+                    with timer.time(stage, items=len(batch)):
+                        embeddings[name] += udf.func(batch).tolist()
+                # Second pass over the same chunks is served by the embedding cache
+                for i in range(0, len(contents), embed_batch_size):
+                    batch = pd.Series(contents[i:i + embed_batch_size])
+                    with timer.time(f"{stage}_cached", items=len(batch)):
+                        udf.func(batch)
+
+            df = pd.DataFrame({"id": range(len(chunks)), "state": [p.split("/")[5] for p, _ in chunks],
+                               "url": [p for p, _ in chunks], "content": contents})
+            config = RAGConfig(indexed_states=list(benchmark_states), use_answer_cache=False)
+            indexes, local_indexes = {}, {}
+            for name, index_name in (("bge", config.bge_index_name), ("ada", config.ada_index_name)):
+                with timer.time(f"build_{name}_index", items=len(df)):
+                    local_indexes[name] = LocalVectorIndex.from_pandas(df.assign(embedding=embeddings[name]),
+                                                                       "embedding", dtype=index_dtype)
+                    indexes[name] = LocalVectorSearchClient({index_name: local_indexes[name]})
+            lexical_index = None
+            if lexical:
+                with timer.time("build_bm25_index", items=len(df)):
+                    lexical_index = BM25Index.from_pandas(df)
+            else:
+                config.use_lexical_index = False
+
+            rag = PrivacyActRAG(config, vsc_bge=indexes["bge"], vsc_ada=indexes["ada"], lexical_index=lexical_index)
+            if not real_reranker:
+                rag.components["reranker"] = FakeReranker(rerank_per_pair_s)
+            rag.components["generator"] = FakeGenerator(chat_ttft_s, chat_per_token_s, chat_tokens)
+            with timer.time("warm_up"):
+                rag.warm_up()
+
+            # Query embeddings start cold as well
+            caches.append(EmbeddingCache(os.path.join(workdir, "query_cache.sqlite")))
+            set_worker_resource("embedding_cache", caches[-1])
+            queries = make_queries(num_queries, seed=seed)
+            for query in queries:
+                with timer.time("state_detection"):
+                    filters = rag.detect_states(query)
+                retrieved = rag.retriever.retrieve(query, filters)
+                t = retrieved["timings"]
+                timer.record("retrieval", t["total_s"])
+                for leg in rag.retriever.legs:
+                    timer.record(f"retrieval_{leg}_embed", t[f"{leg}_embed_s"])
+                    timer.record(f"retrieval_{leg}_search", t[f"{leg}_search_s"])
+                with timer.time("fusion"):
+                    reciprocal_rank_fusion(list(retrieved["legs"].values()))
+                with timer.time("rerank", items=len(retrieved["docs"])):
+                    reranked = rag.reranker.rerank(query, retrieved["docs"], max_candidates=config.rerank_candidates)
+                with timer.time("pack_context"):
+                    packed = pack_context(reranked, config.context_token_budget)
+                stats = {}
+                with timer.time("generation"):
+                    for _ in rag.generator.stream(config.answer_prompt.format(query=query, context=packed["context"]),
+                                                  context_ids=[d[0] for d in packed["docs"]], stats=stats):
+                        pass
+                timer.record("generation_ttft", stats["ttft_s"])
+
+            for query in queries:
+                timer.record("end_to_end", rag.answer(query)["latency_s"])
+            with timer.time("end_to_end_batch", items=len(queries)):
+                rag.answer_batch(queries)
+
+            index_recall = {}
+            if np.dtype(index_dtype) != np.float32:
+                # What the compact indexes lose against float32 ones on the benchmark queries
+                for name, embed in (("bge", rag.embed_bge), ("ada", rag.embed_ada)):
+                    reference = LocalVectorIndex.from_pandas(df.assign(embedding=embeddings[name]), "embedding")
+                    index_recall[name] = recall_at_k(reference, local_indexes[name], [embed(q) for q in queries],
+                                                     k=config.num_results)
+
+            return {
+                "config": {"num_docs": num_docs, "num_pages": num_pages, "num_queries": num_queries,
+                           "embed_latency_s": embed_latency_s, "embed_per_input_s": embed_per_input_s,
+                           "chat_ttft_s": chat_ttft_s, "chat_per_token_s": chat_per_token_s, "chat_tokens": chat_tokens,
+                           "rerank_per_pair_s": None if real_reranker else rerank_per_pair_s,
+                           "doc_batch_size": doc_batch_size, "embed_batch_size": embed_batch_size,
+                           "rate_limits": rate_limits, "batch_concurrency": config.batch_concurrency,
+                           "index_dtype": np.dtype(index_dtype).name, "lexical": lexical,
+                           "num_results": config.num_results, "rerank_candidates": config.rerank_candidates,
+                           "seed": seed},
+                "environment": {"python": sys.version.split()[0], "platform": platform.platform(),
+                                "cpu_count": os.cpu_count()},
+                "corpus": {"docs": len(corpus), "pdf_bytes": sum(len(pdf) for _, pdf in corpus), "chunks": len(chunks)},
+                "endpoint_calls": {"bge": deploy_client.calls, "ada": ada_client.calls},
+                "stages": timer.summary(),
+                **({"bm25_index": lexical_index.nbytes()} if lexical_index is not None else {}),
+                **({"index_recall": index_recall} if index_recall else {}),
+                **({"tracing": tracing.snapshot()} if tracing.is_enabled() else {}),
+            }
+    finally:
+        for cache in caches:
+            cache.conn.close()
+        if owns_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare_reports(baseline, report, metrics=("p50_s", "p95_s", "p99_s", "throughput_per_s")):
+    # Ratio new / baseline per stage and metric (>1 on a latency or <1 on a throughput is a regression)
+    return {stage: {m: report["stages"][stage][m] / baseline["stages"][stage][m]
+                    for m in metrics if baseline["stages"][stage].get(m) and report["stages"][stage].get(m) is not None}
+            for stage in report["stages"] if stage in baseline["stages"]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=8)
+    parser.add_argument("--pages", type=int, default=50)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--embed-latency-ms", type=float, default=20)
+    parser.add_argument("--chat-ttft-ms", type=float, default=300)
+    parser.add_argument("--chat-token-ms", type=float, default=10)
+    parser.add_argument("--rerank-pair-ms", type=float, default=5)
+    parser.add_argument("--real-reranker", action="store_true")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the client-side embedding rate limits")
+    parser.add_argument("--index-dtype", default="float32", choices=["float32", "float16", "int8"],
+                        help="scan dtype of the local indexes (compact ones also report their recall@k)")
+    parser.add_argument("--no-lexical", action="store_true", help="vector legs only, without the BM25 leg")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", help="JSONL file for the tracing spans (also adds the trace metrics to the report)")
+    parser.add_argument("--output")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    args = parser.parse_args()
+    if args.trace:
+        tracing.enable_tracing(args.trace)
+
+    report = run_benchmark(num_docs=args.docs, num_pages=args.pages, num_queries=args.queries,
+                           embed_latency_s=args.embed_latency_ms / 1000, chat_ttft_s=args.chat_ttft_ms / 1000,
+                           chat_per_token_s=args.chat_token_ms / 1000, rerank_per_pair_s=args.rerank_pair_ms / 1000,
+                           real_reranker=args.real_reranker, rate_limits=args.rate_limits,
+                           index_dtype=args.index_dtype, lexical=not args.no_lexical, seed=args.seed)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["vs_baseline"] = compare_reports(json.load(f), report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
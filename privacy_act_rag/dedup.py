@@ -0,0 +1,34 @@
+# MinHash signatures for near-duplicate chunks (boilerplate repeated across the state acts). Signatures are
+# computed in Python with fixed hash parameters, so every worker and every run gives the same values; the LSH
+# banding and the pair checks run in Spark (see ingest.near_duplicate_ids).
+import re
+import zlib
+
+import numpy as np
+
+minhash_num_perm = 64
+# 8 bands of 8 rows: pairs above ~0.77 Jaccard share a band with high probability
+minhash_bands = 8
+shingle_words = 5
+near_duplicate_threshold = 0.8
+
+_mersenne_prime = (1 << 61) - 1
+_params = np.random.default_rng(1).integers(1, (1 << 31) - 1, size=(2, minhash_num_perm), dtype=np.uint64)
+
+
+def shingle_hashes(txt, k=shingle_words):
+    # crc32 of each k-word window of the lower-cased words (the whole text when it is shorter than k words)
+    words = re.findall(r"\w+", txt.lower())
+    windows = [" ".join(words[i:i + k]) for i in range(max(1, len(words) - k + 1))]
+    return np.asarray([zlib.crc32(w.encode("utf-8")) for w in windows], dtype=np.uint64)
+
+
+def minhash_signature(txt, num_perm=minhash_num_perm):
+    # min over the shingles of (a * x + b) mod p for num_perm (a, b) pairs; 32-bit x and a keep a * x in uint64
+    x = shingle_hashes(txt)
+    a, b = _params[0, :num_perm], _params[1, :num_perm]
+    return ((np.outer(x, a) + b) % np.uint64(_mersenne_prime)).min(axis=0).astype(np.int64)
+
+
+def estimated_jaccard(sig_a, sig_b):
+    return float(np.mean(np.asarray(sig_a) == np.asarray(sig_b)))
@@ -0,0 +1,230 @@
+# Adaptive dispatch of embedding requests. One dispatcher per model and Python worker (shared by every UDF
+# batch and query that worker runs) holds the rate limits, the AIMD batch size / concurrency and the retries.
+# Inputs that still fail come back as None with an error record instead of failing the Spark task.
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from privacy_act_rag import tracing
+
+
+class TokenBucket:
+    # rate units per second, bursts up to capacity. pause() blocks every caller (e.g. for a Retry-After).
+    # A request larger than the bucket waits for a full bucket and is then charged in full: the bucket goes
+    # negative and the next callers wait off the debt, so the long-run rate holds for any request size.
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, cost=1):
+        needed = min(cost, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.paused_until - now
+                if wait <= 0 and self.tokens >= needed:
+                    self.tokens -= cost
+                    return
+                wait = max(wait, (needed - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class AdaptiveLimits:
+    # Additive increase / multiplicative decrease of the batch size and of the requests in flight: fast
+    # successes grow them, throttling halves both, slow responses shrink the batch size.
+    def __init__(self, max_batch_size, max_concurrency, min_batch_size=1, target_latency_s=5.0):
+        self.max_batch_size = max_batch_size
+        self.min_batch_size = min_batch_size
+        self.max_concurrency = max_concurrency
+        self.target_latency_s = target_latency_s
+        self.batch_size = max_batch_size
+        self.concurrency = max(1, max_concurrency // 2)
+        self.batch_step = max(1, max_batch_size // 10)
+        self.in_flight = 0
+        self.fast_in_a_row = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= self.concurrency:
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def on_success(self, latency_s):
+        with self.cond:
+            if latency_s > self.target_latency_s:
+                self.fast_in_a_row = 0
+                self.batch_size = max(self.min_batch_size, int(self.batch_size * 0.75))
+                return
+            self.fast_in_a_row += 1
+            self.batch_size = min(self.max_batch_size, self.batch_size + self.batch_step)
+            # Roughly one more request in flight per round of concurrent requests that came back fast
+            if self.fast_in_a_row >= self.concurrency and self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self.fast_in_a_row = 0
+                self.cond.notify_all()
+
+    def on_throttle(self):
+        with self.cond:
+            self.fast_in_a_row = 0
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+            self.concurrency = max(1, self.concurrency // 2)
+
+    def state(self):
+        with self.cond:
+            return {"batch_size": self.batch_size, "concurrency": self.concurrency, "in_flight": self.in_flight}
+
+
+def error_status(e):
+    # HTTP status of an endpoint error: openai / requests errors carry it, MLflow only has it in the message
+    for obj in (e, getattr(e, "response", None)):
+        status = getattr(obj, "status_code", None)
+        if isinstance(status, int):
+            return status
+    match = re.search(r"(?:error|status) code:? (\d{3})", str(e))
+    return int(match.group(1)) if match else None
+
+
+def retry_after_s(e):
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("Retry-After"):
+            return float(headers["Retry-After"])
+    except ValueError:
+        pass
+    return None
+
+
+def is_throttled(e, status):
+    return status == 429 or bool(re.search(r"rate.?limit|too many requests|REQUEST_LIMIT_EXCEEDED", str(e), re.I))
+
+
+def is_input_error(e, status):
+    # Errors caused by what was sent (a too long or rejected input) rather than by the endpoint or the credentials
+    return status in (400, 413, 422) or isinstance(e, EmbeddingCountMismatch)
+
+
+class EmbeddingCountMismatch(ValueError):
+    pass
+
+
+def is_transient(e, status):
+    if status is not None:
+        return status == 408 or status >= 500
+    return isinstance(e, (TimeoutError, ConnectionError)) or any(
+        s in type(e).__name__ for s in ("Timeout", "Connection"))
+
+
+class EmbeddingDispatcher:
+    def __init__(self, name, max_batch_size, max_concurrency=4, requests_per_s=None, units_per_s=None,
+                 max_batch_units=None, max_retries=5, backoff_base_s=0.5, backoff_max_s=30.0, target_latency_s=5.0):
+        # units are whatever the endpoint meters besides requests (tokens for ADA); max_batch_units bounds a batch
+        self.name = name
+        self.limits = AdaptiveLimits(max_batch_size, max_concurrency, target_latency_s=target_latency_s)
+        self.request_bucket = TokenBucket(requests_per_s) if requests_per_s else None
+        self.unit_bucket = TokenBucket(units_per_s) if units_per_s else None
+        self.max_batch_units = max_batch_units
+        self.max_retries = max_retries
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+        self.pool = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def embed(self, texts, call, units=None):
+        # call(list of texts) -> list of vectors in the same order. units[i] is the metered cost of texts[i].
+        # Returns (vectors, errors): vectors[i] is None for the inputs listed in errors ({i: record}).
+        vectors, errors = [None] * len(texts), {}
+        pending = deque(range(len(texts)))
+        futures = []
+        while pending:
+            # The batch size is read per batch, so a throttled call shrinks the batches still to be sent
+            self.limits.acquire()
+            batch, batch_units = [], 0
+            while pending and len(batch) < self.limits.batch_size:
+                cost = units[pending[0]] if units else 0
+                if batch and self.max_batch_units and batch_units + cost > self.max_batch_units:
+                    break
+                batch.append(pending.popleft())
+                batch_units += cost
+            futures.append(self.pool.submit(self._run, batch, texts, call, units, vectors, errors))
+        for f in futures:
+            f.result()
+        if errors:
+            logging.warning(f"{self.name}: {len(errors)} of {len(texts)} inputs could not be embedded, "
+                            f"e.g. {next(iter(errors.values()))}")
+        return vectors, errors
+
+    def _run(self, batch, texts, call, units, vectors, errors):
+        try:
+            self._send(batch, texts, call, units, vectors, errors)
+        finally:
+            self.limits.release()
+
+    def _send(self, batch, texts, call, units, vectors, errors):
+        for attempt in range(self.max_retries + 1):
+            if self.request_bucket:
+                self.request_bucket.acquire()
+            if self.unit_bucket and units:
+                self.unit_bucket.acquire(sum(units[i] for i in batch))
+            start = time.perf_counter()
+            try:
+                result = call([texts[i] for i in batch])
+                if len(result) != len(batch):
+                    raise EmbeddingCountMismatch(f"{len(result)} embeddings returned for {len(batch)} inputs")
+            except Exception as e:
+                status = error_status(e)
+                throttled = is_throttled(e, status)
+                retryable = throttled or is_transient(e, status)
+                tracing.count("embedding.errors")
+                if throttled:
+                    tracing.count("embedding.throttled")
+                    self.limits.on_throttle()
+                    if self.request_bucket:
+                        self.request_bucket.pause(retry_after_s(e) or self.backoff_base_s)
+                if retryable and attempt < self.max_retries:
+                    tracing.count("embedding.retries")
+                    time.sleep(self.backoff_s(attempt, retry_after_s(e)))
+                    continue
+                if not retryable and is_input_error(e, status) and len(batch) > 1:
+                    # A bad input (too long, rejected content) fails the whole request: split until it's alone.
+                    # Auth / permission errors fail every input alike, so they fail the batch at once.
+                    tracing.count("embedding.bisections")
+                    mid = len(batch) // 2
+                    self._send(batch[:mid], texts, call, units, vectors, errors)
+                    self._send(batch[mid:], texts, call, units, vectors, errors)
+                    return
+                tracing.count("embedding.failed_inputs", len(batch))
+                record = json.dumps({"error": repr(e)[:1000], "status": status, "attempts": attempt + 1,
+                                     "batch_size": len(batch)})
+                for i in batch:
+                    errors[i] = record
+                return
+            self.limits.on_success(time.perf_counter() - start)
+            for i, v in zip(batch, result):
+                vectors[i] = v
+            return
+
+    def backoff_s(self, attempt, retry_after=None):
+        # Full jitter, never shorter than what the endpoint asked for
+        return max(retry_after or 0.0, random.uniform(0, min(self.backoff_max_s, self.backoff_base_s * 2 ** attempt)))
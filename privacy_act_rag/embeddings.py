@@ -0,0 +1,190 @@
+# Embedding endpoints (Databricks BGE, Azure ADA) and the content-hash embedding cache they share
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from array import array
+
+from privacy_act_rag import tracing
+from privacy_act_rag.dispatch import EmbeddingDispatcher
+from privacy_act_rag.resources import get_worker_resource
+
+bge_embed_model = "databricks-bge-large-en"
+# The BGE endpoint takes at most 150 inputs per request
+bge_max_batch_size = 150
+
+ada_embed_model = "nous-ue2-openai-sbx-base-deploy-text-embedding-ada-002"
+azure_openai_endpoint = "https://nous-ue2-openai-sbx-openai.openai.azure.com/"
+azure_openai_api_version = "2023-05-15"
+# Azure caps ada-002 requests at 16 inputs; the token budget keeps large chunks from blowing the request size
+ada_max_batch_size = 16
+ada_max_batch_tokens = 8191
+# Upper bound on the embedding requests kept in flight per Python worker (the dispatcher adapts below it)
+ada_max_concurrency = 4
+bge_max_concurrency = 4
+# Client-side rate limits per Python worker, kept under the endpoint quotas divided by the expected workers
+bge_requests_per_s = 5
+ada_requests_per_s = 5
+ada_tokens_per_s = 1000
+
+# SQLite fallback lives on the local disk of each node (driver and executors)
+embedding_cache_path = "/local_disk0/tmp/embedding_cache.sqlite"
+
+
+def normalize_chunk(txt):
+    # Must stay in line with ingest.chunk_hash_col: collapse ASCII whitespace and trim spaces
+    return re.sub(r'\s+', ' ', txt, flags=re.ASCII).strip(' ')
+
+
+def chunk_hash(txt):
+    return hashlib.sha256(normalize_chunk(txt).encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    # (model, chunk hash) -> embedding, stored as float32 blobs in SQLite
+    def __init__(self, path=embedding_cache_path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # The connection is shared by the embedding threads of a process
+        self.lock = threading.Lock()
+        # WAL lets the Python workers of the same node read while one of them writes
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (model TEXT, chunk_hash TEXT, embedding BLOB, PRIMARY KEY (model, chunk_hash))"
+        )
+
+    def get_many(self, model, hashes):
+        found = {}
+        unique = list(set(hashes))
+        # Stay below SQLite's bound parameter limit
+        for i in range(0, len(unique), 500):
+            part = unique[i:i + 500]
+            with self.lock:
+                rows = self.conn.execute(
+                    f"SELECT chunk_hash, embedding FROM embeddings WHERE model = ? AND chunk_hash IN ({','.join('?' * len(part))})",
+                    [model, *part],
+                ).fetchall()
+            for h, blob in rows:
+                found[h] = array('f', blob).tolist()
+        return found
+
+    def put_many(self, model, items):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                [(model, h, array('f', v).tobytes()) for h, v in items],
+            )
+
+
+def get_embedding_cache():
+    # One SQLite connection per process
+    return get_worker_resource("embedding_cache", EmbeddingCache)
+
+
+def cached_embeddings(model, texts, embed_fn, cache=None):
+    # One bulk lookup for the whole batch, only the (deduplicated) misses are sent to embed_fn
+    cache = cache or get_embedding_cache()
+    hashes = [chunk_hash(t) for t in texts]
+    found = cache.get_many(model, hashes)
+    misses = {}
+    for h, t in zip(hashes, texts):
+        if h not in found:
+            misses.setdefault(h, t)
+    tracing.count("embedding_cache.hits", len(texts) - len(misses))
+    tracing.count("embedding_cache.misses", len(misses))
+    if misses:
+        new = list(zip(misses.keys(), embed_fn(list(misses.values()))))
+        # Failed inputs (None) are not cached, the next run asks the endpoint again
+        cache.put_many(model, [(h, v) for h, v in new if v is not None])
+        found.update(new)
+    return [found[h] for h in hashes]
+
+
+def load_bge_dispatcher():
+    return EmbeddingDispatcher(bge_embed_model, bge_max_batch_size, bge_max_concurrency, requests_per_s=bge_requests_per_s)
+
+
+def load_ada_dispatcher():
+    return EmbeddingDispatcher(ada_embed_model, ada_max_batch_size, ada_max_concurrency, requests_per_s=ada_requests_per_s,
+                               units_per_s=ada_tokens_per_s, max_batch_units=ada_max_batch_tokens)
+
+
+def get_deploy_client():
+    def load():
+        import mlflow.deployments
+        return mlflow.deployments.get_deploy_client("databricks")
+    return get_worker_resource("deploy_client", load)
+
+
+def get_ada_client(api_key=None, azure_endpoint=azure_openai_endpoint):
+    # api_key defaults to AZURE_OPENAI_API_KEY; executors get it passed explicitly since they don't share the env
+    def load():
+        from openai import AzureOpenAI
+        return AzureOpenAI(
+            api_key = api_key or os.environ["AZURE_OPENAI_API_KEY"],
+            api_version = azure_openai_api_version,
+            azure_endpoint = azure_endpoint,
+            )
+    return get_worker_resource("ada_client", load)
+
+
+def embed_bge(texts, deploy_client=None, errors=None):
+    # None for the texts that could not be embedded; errors (if given) receives {chunk_hash: error record}
+    deploy_client = deploy_client or get_deploy_client()
+
+    def embed_batch(batch):
+        # The dispatcher keeps batches within the endpoint's 150 inputs per request
+        with tracing.span("embed_batch", model=bge_embed_model, inputs=len(batch)):
+            response = deploy_client.predict(endpoint=bge_embed_model, inputs={"input": batch})
+        tracing.count("embedding.calls")
+        tracing.count("embedding.inputs", len(batch))
+        return [e['embedding'] for e in response.data]
+
+    vectors, failed = get_worker_resource("bge_dispatcher", load_bge_dispatcher).embed(texts, embed_batch)
+    if errors is not None:
+        errors.update({chunk_hash(texts[i]): record for i, record in failed.items()})
+    return vectors
+
+
+def load_ada_encoding():
+    import tiktoken
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def embed_ada(texts, ada_client=None, errors=None):
+    # Same contract as embed_bge; batches are bounded by item count and by tokens
+    ada_client = ada_client or get_ada_client()
+    encoding = get_worker_resource("cl100k_encoding", load_ada_encoding)
+    tokens = [len(encoding.encode(t, disallowed_special=())) for t in texts]
+
+    def embed_batch(batch):
+        with tracing.span("embed_batch", model=ada_embed_model, inputs=len(batch)):
+            response = ada_client.embeddings.create(input=batch, model=ada_embed_model)
+        tracing.count("embedding.calls")
+        tracing.count("embedding.inputs", len(batch))
+        # Items come back with their position in the request, don't rely on the response order
+        return [e.embedding for e in sorted(response.data, key=lambda e: e.index)]
+
+    vectors, failed = get_worker_resource("ada_dispatcher", load_ada_dispatcher).embed(texts, embed_batch, units=tokens)
+    tracing.count("embedding.tokens", sum(tokens))
+    if errors is not None:
+        errors.update({chunk_hash(texts[i]): record for i, record in failed.items()})
+    return vectors
+
+
+def embed_query(model, query, embed_fn):
+    # A query has no row to carry a null vector, so a failed query embedding is raised
+    errors = {}
+    vector = cached_embeddings(model, [query], lambda texts: embed_fn(texts, errors=errors))[0]
+    if vector is None:
+        raise RuntimeError(f"embedding the query with {model} failed: {errors.get(chunk_hash(query))}")
+    return vector
+
+
+def get_bge_embeddings(query):
+    return embed_query(bge_embed_model, query, embed_bge)
+
+
+def open_ai_embeddings(contents):
+    return embed_query(ada_embed_model, contents, embed_ada)
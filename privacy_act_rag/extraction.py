@@ -0,0 +1,314 @@
+# Document text extraction and chunking: streaming PDF sections, the parsing process pool and the
+# synthetic PDF / peak RSS helpers used to size the Arrow batches
+import io
+import logging
+import multiprocessing
+import os
+import queue
+import re
+import signal
+import threading
+import time
+from typing import Iterator
+
+from privacy_act_rag import tracing
+from privacy_act_rag.resources import get_chunk_splitter, get_worker_resource, load_partitioner
+
+# Spark already runs one Python worker per core, keep the per-worker pool small (or raise spark.task.cpus)
+parse_max_workers = 4
+# Documents still being parsed after this many seconds keep the text extracted so far
+parse_timeout_s = 300
+# Cap on the text taken from a single document
+parse_max_doc_chars = 5_000_000
+# A pool worker still on one document this long after its deadline (stuck in C code where SIGALRM can't
+# interrupt it) is killed and replaced
+parse_kill_grace_s = 30
+
+
+def clean_section(txt):
+    txt = re.sub(r'\n', '', txt)
+    return re.sub(r' ?\.', '.', txt)
+
+
+def extract_doc_text(x : bytes) -> str:
+    # Read files and extract the values with unstructured
+    with tracing.span("extract", bytes=len(x)):
+        sections = get_worker_resource("partitioner", load_partitioner)(file=io.BytesIO(x))
+    # Default split is by section of document, concatenate them all together because we want to split by sentence instead.
+    return "\n".join([clean_section(s.text) for s in sections]) 
+
+
+def iter_doc_sections(x : bytes) -> Iterator[str]:
+    # PDFs are walked page by page with pdfminer (the engine unstructured uses for text PDFs), so only one
+    # page of layout objects is alive at a time. Other formats, and scanned PDFs without a text layer (which
+    # partition OCRs), still go through partition.
+    if x[:5] == b"%PDF-":
+        from pdfminer.high_level import extract_pages
+        from pdfminer.layout import LTTextContainer
+        found = False
+        for page in extract_pages(io.BytesIO(x)):
+            for element in page:
+                if isinstance(element, LTTextContainer):
+                    txt = clean_section(element.get_text().replace("\n", " ")).strip()
+                    if txt:
+                        found = True
+                        yield txt
+        if found:
+            return
+        logging.info(f"no text layer in a {len(x)} byte PDF, falling back to partition")
+        tracing.count("extract.partition_fallbacks")
+    for s in get_worker_resource("partitioner", load_partitioner)(file=io.BytesIO(x)):
+        yield clean_section(s.text)
+
+
+def iter_doc_chunks(x : bytes, splitter, flush_chars=20000, max_doc_chars=parse_max_doc_chars) -> Iterator[str]:
+    # Sections are buffered up to flush_chars and split; every chunk but the last is emitted and the last one is
+    # carried into the next buffer so sentences crossing the flush point still end up in one chunk.
+    # max_doc_chars caps the text taken from a single document. A ParseTimeout (chunk_document's deadline) ends
+    # the extraction and the text read so far is still chunked; the rest of the document is dropped.
+    buffer, buffered, total = [], 0, 0
+    try:
+        for section in tracing.timed_iter("extract", iter_doc_sections(x), bytes=len(x)):
+            if total + len(section) > max_doc_chars:
+                logging.warning(f"document truncated to its first {max_doc_chars} characters")
+                section = section[:max_doc_chars - total]
+            buffer.append(section)
+            buffered += len(section) + 1
+            total += len(section)
+            if buffered >= flush_chars:
+                chunks = split_text(splitter, "\n".join(buffer))
+                yield from chunks[:-1]
+                buffer = chunks[-1:]
+                buffered = sum(len(c) for c in buffer)
+            if total >= max_doc_chars:
+                break
+    except ParseTimeout:
+        tracing.count("parse.timeouts")
+        if total or x[:5] == b"%PDF-":
+            logging.warning(f"parsing a {len(x)} byte document hit its deadline, keeping its first {total} characters")
+        else:
+            # partition gave nothing back in time for a non-PDF format: its raw text is all there is to take
+            logging.warning(f"partitioning a {len(x)} byte document hit its deadline, using its raw text")
+            buffer = [clean_section(x.decode("utf-8", errors="ignore")[:max_doc_chars].replace("\n", " "))]
+    if buffer:
+        yield from split_text(splitter, "\n".join(buffer))
+
+
+def split_text(splitter, txt):
+    with tracing.span("split", chars=len(txt)) as s:
+        chunks = splitter.split_text(txt)
+        s.set(chunks=len(chunks))
+    tracing.count("split.chunks", len(chunks))
+    return chunks
+
+
+class ParseTimeout(Exception):
+    pass
+
+
+def _raise_parse_timeout(signum, frame):
+    raise ParseTimeout()
+
+
+def chunk_document(x : bytes, splitter, timeout_s=None, max_doc_chars=parse_max_doc_chars):
+    # SIGALRM can only be armed from the main thread; elsewhere the document is parsed without a deadline (the
+    # pool in parse_documents still kills a worker that overruns it). Nothing is re-parsed after the deadline.
+    use_alarm = bool(timeout_s) and threading.current_thread() is threading.main_thread()
+    if use_alarm:
+        previous = signal.signal(signal.SIGALRM, _raise_parse_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout_s)
+    tracing.count("parse.documents")
+    tracing.count("parse.bytes", len(x))
+    chunks = []
+    try:
+        with tracing.span("parse_document", bytes=len(x)):
+            for chunk in iter_doc_chunks(x, splitter, max_doc_chars=max_doc_chars):
+                chunks.append(chunk)
+    except ParseTimeout:
+        # The deadline hit while the last buffer was being split: the chunks emitted so far are kept
+        tracing.count("parse.timeouts")
+        logging.warning(f"splitting a {len(x)} byte document hit its deadline, keeping its first {len(chunks)} chunks")
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+    return chunks
+
+
+def _parse_worker(tasks, results, timeout_s, max_doc_chars, started, slot):
+    # Forked worker loop. Only (index, bytes) tasks and chunk lists go through the queues, so a dead worker
+    # can be detected and nothing but plain data is pickled. The tracing metrics of each document travel back
+    # with its chunks (the registry copied from the parent at fork time is dropped first).
+    # started[2 * slot:2 * slot + 2] holds (document index, monotonic start) while a document is parsed, -1 otherwise.
+    tracing.reset()
+    splitter = get_chunk_splitter()
+    for i, x in iter(tasks.get, None):
+        started[2 * slot:2 * slot + 2] = [i, time.monotonic()]
+        try:
+            doc_chunks, error = chunk_document(x, splitter, timeout_s, max_doc_chars), None
+        except Exception as e:
+            doc_chunks, error = None, repr(e)
+        started[2 * slot] = -1
+        results.put((i, doc_chunks, error, tracing.drain()))
+    tracing.flush()
+
+
+def parse_documents(docs, max_workers=parse_max_workers, timeout_s=parse_timeout_s, max_doc_chars=parse_max_doc_chars):
+    # Chunk documents across local worker processes. The largest files are queued first so a big statute
+    # doesn't start last and hold up the whole batch. Results come back in input order.
+    # With a timeout the documents always go through the pool, where the parent can kill a worker that overruns
+    # it by parse_kill_grace_s; the batch then fails with those documents as errors once the rest are parsed.
+    if not docs:
+        return []
+    max_workers = min(max_workers or os.cpu_count() or 1, len(docs))
+    if max_workers <= 1 and not timeout_s:
+        splitter = get_chunk_splitter()
+        return [chunk_document(x, splitter, timeout_s, max_doc_chars) for x in docs]
+
+    # Load the tokenizer once here, the forked workers inherit it
+    get_chunk_splitter()
+    ctx = multiprocessing.get_context("fork")
+    tasks, results = ctx.Queue(), ctx.Queue()
+    for i in sorted(range(len(docs)), key=lambda i: len(docs[i]), reverse=True):
+        tasks.put((i, docs[i]))
+    for _ in range(max_workers):
+        tasks.put(None)
+    started = ctx.Array("d", [-1.0, 0.0] * max_workers)
+    deadline_s = timeout_s + parse_kill_grace_s if timeout_s else None
+
+    def start_worker(slot):
+        w = ctx.Process(target=_parse_worker, args=(tasks, results, timeout_s, max_doc_chars, started, slot),
+                        daemon=True)
+        w.start()
+        return w
+
+    workers = [start_worker(slot) for slot in range(max_workers)]
+    chunks = [None] * len(docs)
+    pending, killed = set(range(len(docs))), []
+    try:
+        while pending:
+            try:
+                i, doc_chunks, error, metrics = results.get(timeout=1)
+            except queue.Empty:
+                # A worker killed by the OOM killer or a segfault never reports back
+                if any(w.exitcode not in (None, 0) for w in workers):
+                    raise RuntimeError("a document parsing worker died")
+            else:
+                tracing.merge(metrics)
+                if error is not None:
+                    raise RuntimeError(f"parsing document {i} failed: {error}")
+                chunks[i] = doc_chunks
+                pending.discard(i)
+            if deadline_s is None:
+                continue
+            for slot, w in enumerate(workers):
+                # Killed under the lock, so the worker can't be holding it
+                with started.get_lock():
+                    i, start = int(started[2 * slot]), started[2 * slot + 1]
+                    overran = i >= 0 and time.monotonic() - start > deadline_s
+                    if overran:
+                        w.kill()
+                        started[2 * slot] = -1
+                if not overran:
+                    continue
+                w.join()
+                tracing.count("parse.killed")
+                logging.error(f"parsing document {i} ({len(docs[i])} bytes) was still running {deadline_s}s after "
+                              f"it started, worker killed")
+                if i in pending:
+                    pending.discard(i)
+                    killed.append(i)
+                # The replacement takes the stop sentinel the killed worker never read
+                workers[slot] = start_worker(slot)
+    finally:
+        for w in workers:
+            w.join(timeout=1)
+            if w.is_alive():
+                w.terminate()
+    if killed:
+        raise RuntimeError(f"parsing documents {sorted(killed)} overran the {timeout_s}s timeout, "
+                           f"their workers were killed")
+    return chunks
+
+
+def backfill_chunks(paths, max_workers=None, timeout_s=parse_timeout_s, max_doc_chars=parse_max_doc_chars):
+    # Outside Spark (e.g. a /Volumes folder on the driver): yields (path, chunks) a few pool-fulls at a time
+    max_workers = max_workers or os.cpu_count() or 1
+    step = max_workers * 4
+    for i in range(0, len(paths), step):
+        group = paths[i:i + step]
+        docs = []
+        for path in group:
+            with open(path, "rb") as f:
+                docs.append(f.read())
+        yield from zip(group, parse_documents(docs, max_workers, timeout_s, max_doc_chars))
+
+
+def make_synthetic_pdf(num_pages=500, lines_per_page=45, seed=0) -> bytes:
+    # Minimal hand-written PDF (one Helvetica text stream per page) that pdfminer and unstructured can read
+    import random
+    rng = random.Random(seed)
+    words = ("consumer controller processor personal data biometric privacy right request opt-out sale "
+             "notice section act state shall may means including purpose business disclosure").split()
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in range(num_pages):
+        lines = [f"Section {page + 1}.{i + 1}. " + " ".join(rng.choice(words) for _ in range(12)) + "."
+                 for i in range(lines_per_page)]
+        stream = "BT /F1 9 Tf 11 TL 40 800 Td " + " ".join(f"({l}) Tj T*" for l in lines) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {num_pages} >>"
+    out, offsets = bytearray(b"%PDF-1.4\n"), []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n{obj}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    out += "".join(f"{o:010d} 00000 n \n" for o in offsets).encode("latin-1")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    return bytes(out)
+
+
+def _rss_kib(field):
+    with open("/proc/self/status") as f:
+        return next(int(l.split()[1]) for l in f if l.startswith(field + ":"))
+
+
+def measure_peak_rss(fn):
+    # Run fn in a forked child and report how far its peak RSS rose above the RSS it started with (MiB).
+    # The child sends back its exception instead, and the parent's copy of the child end is closed so recv
+    # gets EOFError rather than hanging if the child dies without sending anything.
+    ctx = multiprocessing.get_context("fork")
+    parent_conn, child_conn = ctx.Pipe()
+    def target():
+        try:
+            start = _rss_kib("VmRSS")
+            fn()
+            child_conn.send((None, (_rss_kib("VmHWM") - start) / 1024))
+        except BaseException as e:
+            child_conn.send((repr(e), None))
+    proc = ctx.Process(target=target)
+    proc.start()
+    child_conn.close()
+    try:
+        error, peak = parent_conn.recv()
+    except EOFError:
+        error, peak = None, None
+    proc.join()
+    if peak is None and error is None:
+        error = f"child exited with code {proc.exitcode}"
+    if error is not None:
+        raise RuntimeError(f"peak RSS measurement failed: {error}")
+    return peak
+
+
+def compare_extraction_peak_rss(pdf_bytes, splitter):
+    # The partitioner is imported before forking so neither side is charged for loading it
+    get_worker_resource("partitioner", load_partitioner)
+    return {
+        "extract_doc_text_mib": measure_peak_rss(lambda: splitter.split_text(extract_doc_text(pdf_bytes))),
+        "iter_doc_chunks_mib": measure_peak_rss(lambda: list(iter_doc_chunks(pdf_bytes, splitter))),
+    }
@@ -0,0 +1,131 @@
+# Answer generation: packing the reranked chunks into the prompt and streaming the Mixtral completion
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+from privacy_act_rag import tracing
+from privacy_act_rag.resources import get_worker_resource, load_chunk_tokenizer
+
+
+def merge_overlap(a, b, min_overlap=20, max_overlap=1000):
+    # a + b without the text they share (the splitter's chunk_overlap), or None when the tail of a is not the
+    # head of b
+    start = a.find(b[:min_overlap], max(0, len(a) - max_overlap))
+    while start != -1:
+        if b.startswith(a[start:]):
+            return a[:start] + b
+        start = a.find(b[:min_overlap], start + 1)
+    return None
+
+
+@tracing.traced("pack_context")
+def pack_context(reranked, token_budget=3000, tokenizer=None, id_index=0, url_index=2, content_index=3):
+    # Walk the reranked (row, score) list best first and keep every distinct chunk that still fits the budget,
+    # counted with the llama tokenizer used by read_as_chunk. Overlapping neighbours from the same url are merged
+    # into one passage so their overlap is only paid once.
+    tokenizer = tokenizer or get_worker_resource("llama_tokenizer", load_chunk_tokenizer)
+    def count(txt):
+        return len(tokenizer.encode(txt, add_special_tokens=False))
+
+    passages, docs, seen, used = [], [], set(), 0
+    for row, score in reranked:
+        text = row[content_index]
+        if text in seen:
+            continue
+        seen.add(text)
+        passage, merged = None, None
+        for p in passages:
+            if p["url"] == row[url_index]:
+                merged = merge_overlap(p["text"], text) or merge_overlap(text, p["text"])
+                if merged is not None:
+                    passage = p
+                    break
+        if passage is not None:
+            cost = count(merged) - count(passage["text"])
+            if used + cost > token_budget:
+                continue
+            passage["text"] = merged
+        else:
+            cost = count(f"[{row[url_index]}]\n{text}\n\n")
+            if used + cost > token_budget:
+                continue
+            passages.append({"url": row[url_index], "text": text})
+        used += cost
+        docs.append(row)
+
+    context = "\n\n".join(f"[{p['url']}]\n{p['text']}" for p in passages)
+    tokens = count(context) if context else 0
+    tracing.observe("context.tokens", tokens)
+    return {"context": context, "docs": docs, "tokens": tokens}
+
+
+class MixtralGenerator:
+    # Chat completions over one pooled HTTP session, streamed token by token (mlflow 2.9's deploy client has no
+    # streaming). Identical (prompt, context ids, params) requests are answered from an LRU of completions.
+    def __init__(self, endpoint="databricks-mixtral-8x7b-instruct", cache_size=256, timeout_s=120):
+        self.endpoint = endpoint
+        self.session = requests.Session()
+        self.timeout_s = timeout_s
+        self.cache_size = cache_size
+        self.completions = OrderedDict()
+        self.lock = threading.Lock()
+        self.last_stats = {}
+
+    def stream(self, prompt, context_ids=(), max_tokens=1500, temperature=0.8, stats=None):
+        # Yields text deltas. stats (if given) receives ttft_s, total_s and cached once the stream is consumed.
+        stats = {} if stats is None else stats
+        self.last_stats = stats
+        key = (prompt, tuple(context_ids), max_tokens, temperature)
+        start = time.perf_counter()
+        with self.lock:
+            completion = self.completions.get(key)
+            if completion is not None:
+                self.completions.move_to_end(key)
+        if completion is not None:
+            stats.update(ttft_s=time.perf_counter() - start, total_s=time.perf_counter() - start, cached=True)
+            tracing.count("generation.cache_hits")
+            yield completion
+            return
+
+        from mlflow.utils.databricks_utils import get_databricks_host_creds
+        creds = get_databricks_host_creds()
+        inputs = {
+            "messages": [{"role":"user","content":prompt}],
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "stream": True
+        }
+        parts = []
+        with self.session.post(f"{creds.host.rstrip('/')}/serving-endpoints/{self.endpoint}/invocations",
+                               headers={"Authorization": f"Bearer {creds.token}"}, json=inputs,
+                               stream=True, timeout=self.timeout_s) as response:
+            response.raise_for_status()
+            # Server-sent events: "data: {chunk}" lines, closed by "data: [DONE]"
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or [{}]
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    if not parts:
+                        stats["ttft_s"] = time.perf_counter() - start
+                    parts.append(delta)
+                    yield delta
+        stats.update(total_s=time.perf_counter() - start, cached=False)
+        tracing.count("generation.calls")
+        tracing.count("generation.deltas", len(parts))
+        tracing.observe("generation.ttft_s", stats.get("ttft_s", stats["total_s"]))
+        tracing.record("generate", stats["total_s"], endpoint=self.endpoint, deltas=len(parts))
+        with self.lock:
+            self.completions[key] = "".join(parts)
+            while len(self.completions) > self.cache_size:
+                self.completions.popitem(last=False)
+
+    def generate(self, prompt, context_ids=(), **params):
+        return "".join(self.stream(prompt, context_ids, **params))
@@ -0,0 +1,308 @@
+# Spark side of the ingest: chunking / embedding pandas UDFs, the Delta embedding cache and the incremental MERGE
+import logging
+import os
+from typing import Iterator
+
+import pandas as pd
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
+from pyspark.sql.functions import pandas_udf
+from pyspark.sql.types import StructType
+
+from privacy_act_rag import tracing
+from privacy_act_rag.dedup import minhash_bands, minhash_num_perm, minhash_signature, near_duplicate_threshold
+from privacy_act_rag.embeddings import (ada_embed_model, azure_openai_endpoint, bge_embed_model, cached_embeddings,
+                                        chunk_hash, embed_ada, embed_bge, get_ada_client)
+from privacy_act_rag.extraction import parse_documents, parse_max_doc_chars
+from privacy_act_rag.quantization import encode_vectors
+from privacy_act_rag.resources import get_chunk_splitter, worker_resource_timings
+
+raw_table = 'demo.hackathon.pdf_raw'
+bge_chunk_table = 'demo.hackathon.databricks_pdf_documentation_baai'
+ada_chunk_table = 'demo.hackathon.databricks_pdf_documentation_openai'
+# Delta side table shared by every ingest run
+embedding_cache_table = "demo.hackathon.embedding_cache"
+# Chunks the embedding endpoints rejected or kept failing on, one row per failure
+embedding_error_table = "demo.hackathon.embedding_errors"
+ingest_state_table = "demo.hackathon.pdf_ingest_state"
+
+
+def active_spark():
+    return SparkSession.getActiveSession() or SparkSession.builder.getOrCreate()
+
+
+def make_chunk_udf(max_doc_chars=parse_max_doc_chars):
+    # The partitioner is only loaded by the parsing workers that meet a non-PDF or a scanned PDF
+    @pandas_udf("array<string>")
+    def read_as_chunk(batch_iter: Iterator[pd.Series]) -> Iterator[pd.Series]:
+        get_chunk_splitter()
+
+        for x in batch_iter:
+            # Streams each document through the splitter instead of materialising its full text
+            with tracing.span("read_as_chunk", documents=len(x)):
+                chunks = parse_documents(x.tolist(), max_doc_chars=max_doc_chars)
+            logging.info(f"from chunk function: {sum(len(c) for c in chunks)} chunks from {len(chunks)} documents")
+            yield pd.Series(chunks)
+        # Python workers can be killed without running atexit hooks
+        tracing.flush()
+
+    return read_as_chunk
+
+
+read_as_chunk = make_chunk_udf()
+
+
+def embedding_results(model, texts, embed_fn):
+    # Embeddings (None where the endpoint failed) and the matching error records
+    errors = {}
+    embeddings = cached_embeddings(model, texts, lambda batch: embed_fn(batch, errors=errors))
+    tracing.flush()
+    return embeddings, [errors.get(chunk_hash(t)) if e is None else None for t, e in zip(texts, embeddings)]
+
+
+# Null for the chunks that could not be embedded, the task itself doesn't fail
+@pandas_udf("array<float>")
+def get_embedding(contents: pd.Series) -> pd.Series:
+    return pd.Series(embedding_results(bge_embed_model, contents.tolist(), embed_bge)[0])
+
+
+# Same with the error record next to the null (embed_with_cache_table writes those to embedding_error_table)
+@pandas_udf("embedding array<float>, error string")
+def get_embedding_result(contents: pd.Series) -> pd.DataFrame:
+    embeddings, errors = embedding_results(bge_embed_model, contents.tolist(), embed_bge)
+    return pd.DataFrame({"embedding": embeddings, "error": errors})
+
+
+def make_ada_embedding_udf(api_key, azure_endpoint=azure_openai_endpoint, with_errors=False):
+    # The key comes from the driver's secret scope and travels with the UDF closure.
+    # with_errors gives the struct variant, like get_embedding_result.
+    def embed(texts, errors):
+        return embed_ada(texts, get_ada_client(api_key, azure_endpoint), errors)
+
+    @pandas_udf("array<float>")
+    def get_ada_embedding(contents: pd.Series) -> pd.Series:
+        return pd.Series(embedding_results(ada_embed_model, contents.tolist(), embed)[0])
+
+    @pandas_udf("embedding array<float>, error string")
+    def get_ada_embedding_result(contents: pd.Series) -> pd.DataFrame:
+        embeddings, errors = embedding_results(ada_embed_model, contents.tolist(), embed)
+        return pd.DataFrame({"embedding": embeddings, "error": errors})
+
+    return get_ada_embedding_result if with_errors else get_ada_embedding
+
+
+def make_quantize_udf(dtype="int8"):
+    # ARRAY<FLOAT> -> BINARY (float32 scale + int8 / float16 codes, see quantization.py); nulls stay null
+    @pandas_udf("binary")
+    def quantize(vectors: pd.Series) -> pd.Series:
+        return pd.Series(encode_vectors(vectors.tolist(), dtype))
+
+    return quantize
+
+
+def compact_embeddings(df, embedding_col, dtype="int8", keep_full=True):
+    # Adds {embedding_col}_{dtype}. The vector search Delta Sync source tables need the ARRAY<FLOAT> column, so the
+    # compact copy is for LocalVectorIndex.from_table(quantized_col=...) and for cheaper storage / scans.
+    df = df.withColumn(f"{embedding_col}_{dtype}", make_quantize_udf(dtype)(F.col(embedding_col)))
+    return df if keep_full else df.drop(embedding_col)
+
+
+def collect_worker_resource_timings(spark=None, partitions=64):
+    # Resource load times per executor Python worker (empty for workers that have not run read_as_chunk yet)
+    spark = spark or active_spark()
+    def timings(_):
+        yield pd.DataFrame([{"pid": os.getpid(), "resource": k, "seconds": v} for k, v in worker_resource_timings().items()],
+                           columns=["pid", "resource", "seconds"])
+    return (spark.range(0, partitions, numPartitions=partitions)
+            .mapInPandas(timings, "pid long, resource string, seconds double")
+            .dropDuplicates(["pid", "resource"]))
+
+
+def collect_trace_metrics(spark=None, partitions=64):
+    # Tracing counters and histogram summaries per executor Python worker (only populated when the executors
+    # run with PRIVACY_ACT_RAG_TRACE set, e.g. through spark.executorEnv)
+    spark = spark or active_spark()
+    def metrics(_):
+        snapshot = tracing.snapshot()
+        rows = [{"pid": os.getpid(), "metric": k, "stat": "count", "value": float(v)} for k, v in snapshot["counters"].items()]
+        rows += [{"pid": os.getpid(), "metric": k, "stat": stat, "value": float(v)}
+                 for k, h in snapshot["histograms"].items() for stat, v in h.items() if v is not None]
+        yield pd.DataFrame(rows, columns=["pid", "metric", "stat", "value"])
+    return (spark.range(0, partitions, numPartitions=partitions)
+            .mapInPandas(metrics, "pid long, metric string, stat string, value double")
+            .dropDuplicates(["pid", "metric", "stat"]))
+
+
+def chunk_hash_col(col):
+    # Spark-side equivalent of embeddings.chunk_hash so the Delta cache and the SQLite cache share their keys
+    return F.sha2(F.trim(F.regexp_replace(col, r'\s+', ' ')), 256)
+
+
+def unpersist_all(persisted):
+    for df in persisted:
+        df.unpersist()
+    persisted.clear()
+
+
+def embed_with_cache_table(df, model, embed_udf, embedding_col, cache_table=embedding_cache_table,
+                           error_table=embedding_error_table, persisted=None):
+    # Only chunks whose (model, hash) is not in the side table go through embed_udf, each distinct chunk once.
+    # df is persisted so the PDFs are not parsed a second time for the final join; the returned DataFrame reads
+    # from it, so it is appended to persisted for the caller to unpersist (unpersist_all) once its writes are done.
+    # Chunks that could not be embedded keep a null embedding_col (and are retried by the next run); with a
+    # struct UDF (get_embedding_result) their error records are appended to error_table.
+    spark = df.sparkSession
+    spark.sql(f"CREATE TABLE IF NOT EXISTS {cache_table} (model STRING, chunk_hash STRING, embedding ARRAY<FLOAT>)")
+    df = df.withColumn("chunk_hash", chunk_hash_col(F.col("content"))).persist()
+    if persisted is not None:
+        persisted.append(df)
+
+    def cached():
+        return (spark.table(cache_table)
+                .where(F.col("model") == model)
+                .dropDuplicates(["chunk_hash"])
+                .select("chunk_hash", "embedding"))
+
+    misses = (df.select("chunk_hash", "content")
+              .dropDuplicates(["chunk_hash"])
+              .join(cached(), "chunk_hash", "left_anti")
+              .select(F.lit(model).alias("model"), "chunk_hash", embed_udf("content").alias("embedding")))
+    try:
+        if isinstance(misses.schema["embedding"].dataType, StructType):
+            # Persisted so the UDF runs once for both writes
+            misses = misses.select("model", "chunk_hash", "embedding.embedding", "embedding.error").persist()
+            (misses.where(F.col("error").isNotNull())
+                .select("model", "chunk_hash", "error", F.current_timestamp().alias("failed_at"))
+                .write.mode("append").saveAsTable(error_table))
+        (misses.where(F.col("embedding").isNotNull()).select("model", "chunk_hash", "embedding")
+            .write.mode("append").saveAsTable(cache_table))
+    finally:
+        misses.unpersist()
+
+    return (df.join(cached().withColumnRenamed("embedding", embedding_col), "chunk_hash", "left")
+            .drop("chunk_hash"))
+
+
+@pandas_udf("array<bigint>")
+def get_minhash(contents: pd.Series) -> pd.Series:
+    return pd.Series([minhash_signature(c).tolist() for c in contents])
+
+
+def signature_similarity(a, b):
+    # Share of equal MinHash values, the estimate of the Jaccard similarity of the two chunks' shingles
+    return F.aggregate(F.zip_with(a, b, lambda x, y: (x == y).cast("int")), F.lit(0), lambda acc, v: acc + v) / F.size(a)
+
+
+def near_duplicate_ids(chunks, reference=None, threshold=near_duplicate_threshold, bands=minhash_bands):
+    # ids of the chunks that are near-duplicates of a chunk of the same state with a smaller id or of any
+    # reference chunk of that state (both DataFrames with id, state and content). Only pairs sharing an LSH band
+    # are compared. The state acts share model text, and a state-filtered query must still find its own copy;
+    # exact repeats across states cost nothing extra to embed thanks to the embedding cache.
+    rows = minhash_num_perm // bands
+
+    def banded(df, is_reference):
+        df = df.select("id", "state", get_minhash("content").alias("minhash"))
+        keys = F.array(*[F.xxhash64(F.lit(i), F.slice("minhash", i * rows + 1, rows)) for i in range(bands)])
+        return df.select("id", "state", "minhash", F.posexplode(keys).alias("band", "band_key"),
+                         F.lit(is_reference).alias("is_reference"))
+
+    new = banded(chunks, False)
+    others = new if reference is None else new.unionByName(banded(reference, True))
+    return (new.alias("n")
+            .join(others.alias("o"), ["state", "band", "band_key"])
+            .where(F.col("o.is_reference") | (F.col("o.id") < F.col("n.id")))
+            .where(signature_similarity(F.col("n.minhash"), F.col("o.minhash")) >= threshold)
+            .select(F.col("n.id").alias("id"))
+            .distinct())
+
+
+def chunk_documents(docs, chunker=read_as_chunk, dedup_threshold=near_duplicate_threshold, reference=None,
+                    persisted=None):
+    # Ids only depend on the document path, the chunk's character offset in the document's chunk stream and
+    # the chunk content, so re-chunking an unchanged PDF gives back the same ids.
+    # Near-duplicate chunks of the same state (within docs, or of reference chunks already in the table) are
+    # dropped here, before anything is embedded; dedup_threshold=None keeps them all.
+    chunks = (docs
+              .select("path", chunker("content").alias("chunks"))
+              .selectExpr("path", """inline(transform(chunks, (c, i) -> named_struct(
+                             'chunk_offset', aggregate(slice(chunks, 1, i), 0L, (acc, x) -> acc + length(x)),
+                             'content', c)))""")
+              .withColumn("id", F.xxhash64("path", "chunk_offset", chunk_hash_col(F.col("content"))))
+              .withColumn("state", F.split(F.col("path"), "/")[5])
+              .selectExpr("id", "path as url", "content", "state"))
+    if dedup_threshold is None:
+        return chunks
+    # Persisted so the PDFs are parsed once for the signatures and the chunks themselves (appended to persisted,
+    # like in embed_with_cache_table)
+    chunks = chunks.persist()
+    if persisted is not None:
+        persisted.append(chunks)
+    return chunks.join(near_duplicate_ids(chunks, reference, dedup_threshold), "id", "left_anti")
+
+
+def incremental_ingest(chunk_table, embedding_col, model, embed_udf, raw_table=raw_table,
+                       state_table=ingest_state_table, chunker=read_as_chunk, sync_index=None, spark=None,
+                       cache_table=embedding_cache_table, error_table=embedding_error_table):
+    # Re-parse, re-chunk and re-embed only the PDFs whose content hash changed since the last run of this
+    # chunk table, then MERGE on the stable chunk id so the Change Data Feed only carries the real deltas.
+    from delta.tables import DeltaTable
+
+    spark = spark or active_spark()
+    spark.sql(f"CREATE TABLE IF NOT EXISTS {state_table} (target STRING, path STRING, doc_hash STRING, ingested_at TIMESTAMP)")
+    spark.sql(f"""CREATE TABLE IF NOT EXISTS {chunk_table} (
+                    id BIGINT, url STRING, content STRING, {embedding_col} ARRAY<FLOAT>, state STRING
+                  ) TBLPROPERTIES (delta.enableChangeDataFeed = true)""")
+
+    raw = spark.table(raw_table).select("path", "content", F.sha2(F.col("content"), 256).alias("doc_hash"))
+    known = spark.table(state_table).where(F.col("target") == chunk_table).select("path", "doc_hash")
+
+    changed = raw.select("path", "doc_hash").join(known, ["path", "doc_hash"], "left_anti")
+    removed = known.select("path").join(raw.select("path"), "path", "left_anti")
+    changed_paths = [r.path for r in changed.select("path").collect()]
+    removed_paths = [r.path for r in removed.collect()]
+    if not changed_paths and not removed_paths:
+        return {"changed_docs": 0, "removed_docs": 0}
+
+    # Unchanged chunks of a changed document are free to re-embed thanks to the embedding cache. New chunks
+    # are checked for near-duplicates against the chunks of the documents this run leaves alone (a chunk
+    # dropped that way only comes back when its own document changes again).
+    kept = spark.table(chunk_table).where(~F.col("url").isin(changed_paths + removed_paths)).select("id", "state", "content")
+    # Everything persisted for this run is released once both MERGEs are done (or failed)
+    persisted = []
+    try:
+        chunks = chunk_documents(raw.where(F.col("path").isin(changed_paths)), chunker, reference=kept,
+                                 persisted=persisted)
+        updates = embed_with_cache_table(chunks, model, embed_udf, embedding_col, cache_table, error_table,
+                                         persisted=persisted).persist()
+        persisted.append(updates)
+        # Documents with chunks that failed to embed stay entirely at their previous version and are not marked
+        # as ingested, so the next run picks them up again
+        failed_paths = [r.url for r in updates.where(F.col(embedding_col).isNull()).select("url").distinct().collect()]
+        updates = updates.where(~F.col("url").isin(failed_paths))
+        replaced_paths = sorted(set(changed_paths) - set(failed_paths)) + removed_paths
+
+        # Matched rows are left untouched; chunks that disappeared from a changed or removed document are deleted
+        (DeltaTable.forName(spark, chunk_table).alias("t")
+            .merge(updates.alias("s"), "t.id = s.id")
+            .whenNotMatchedInsertAll()
+            .whenNotMatchedBySourceDelete(condition=F.col("t.url").isin(replaced_paths))
+            .execute())
+
+        changed = changed.where(~F.col("path").isin(failed_paths))
+        doc_updates = (changed.select(F.lit(chunk_table).alias("target"), "path", "doc_hash",
+                                      F.current_timestamp().alias("ingested_at"))
+                       .unionByName(removed.select(F.lit(chunk_table).alias("target"), "path",
+                                                   F.lit(None).cast("string").alias("doc_hash"),
+                                                   F.current_timestamp().alias("ingested_at"))))
+        (DeltaTable.forName(spark, state_table).alias("t")
+            .merge(doc_updates.alias("s"), "t.target = s.target AND t.path = s.path")
+            .whenMatchedDelete(condition="s.doc_hash IS NULL")
+            .whenMatchedUpdateAll()
+            .whenNotMatchedInsertAll(condition="s.doc_hash IS NOT NULL")
+            .execute())
+    finally:
+        unpersist_all(persisted)
+
+    if sync_index is not None:
+        sync_index()
+    return {"changed_docs": len(changed_paths), "removed_docs": len(removed_paths), "failed_docs": len(failed_paths)}
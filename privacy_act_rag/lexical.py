@@ -0,0 +1,196 @@
+# Lexical leg of the retrieval: a BM25 inverted index over the chunk table, answering similarity_search(query_text=...)
+# like the vector indexes so its rows go through the same rank fusion. Exact statute terms ("biometric data",
+# "controller", "1798.140", "6-1-1303") are what the embedding searches tend to miss.
+# Posting lists are partitioned by state (the filter every query carries) and stored as varint-encoded
+# (doc id gap, term frequency) pairs in one uint8 array, memmapped after load.
+import json
+import math
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+# Section numbers and hyphenated citations stay one token
+token_pattern = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+stopwords = frozenset("""a an and are as at be by for from has have in is it its of on or that the this to was were
+will with which what when who whom whose how does do any all may shall such not no""".split())
+
+default_lexical_index_path = "/local_disk0/tmp/privacy_act_rag/bm25_index"
+
+
+def tokenize(text):
+    return [t for t in token_pattern.findall(text.lower()) if t not in stopwords]
+
+
+def encode_varints(values):
+    # LEB128: 7 bits per byte, high bit set on every byte but the last of a value -> (bytes, bytes per value)
+    values = np.asarray(values, dtype=np.uint64)
+    sizes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        sizes += rest > 0
+        rest >>= np.uint64(7)
+    out = np.empty(int(sizes.sum()), dtype=np.uint8)
+    starts = np.cumsum(sizes) - sizes
+    for k in range(int(sizes.max(initial=0))):
+        sel = sizes > k
+        byte = (values[sel] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        out[starts[sel] + k] = byte | (sizes[sel] > k + 1).astype(np.uint64) << np.uint64(7)
+    return out, sizes
+
+
+def decode_varints(buf):
+    buf = np.asarray(buf, dtype=np.uint8)
+    ends = np.flatnonzero(buf < 0x80)
+    if not len(ends):
+        return np.empty(0, dtype=np.int64)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    group = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = 7 * (np.arange(len(buf)) - starts[group])
+    return np.add.reduceat((buf & 0x7F).astype(np.int64) << shifts, starts)
+
+
+class BM25Index:
+    def __init__(self, rows, doc_len, partitions, postings, lexicon, doc_freq, k1=1.2, b=0.75, partition_column="state"):
+        # partitions: {value: global row positions}; lexicon: {value: {term: (byte offset, byte length)}},
+        # doc ids inside a partition's postings are positions in partitions[value]
+        self.rows = rows
+        self.doc_len = doc_len
+        self.avg_doc_len = float(doc_len.mean()) if len(doc_len) else 0.0
+        self.partitions = partitions
+        self.postings = postings
+        self.lexicon = lexicon
+        self.doc_freq = doc_freq
+        self.k1 = k1
+        self.b = b
+        self.partition_column = partition_column
+
+    @classmethod
+    def from_pandas(cls, df, columns=("id", "state", "url", "content"), text_col="content", partition_column="state",
+                    k1=1.2, b=0.75):
+        counts = [Counter(tokenize(text or "")) for text in df[text_col].tolist()]
+        doc_len = np.asarray([sum(c.values()) for c in counts], dtype=np.int32)
+        doc_freq = Counter(term for c in counts for term in c)
+        groups = {}
+        for i, value in enumerate(df[partition_column].tolist()):
+            groups.setdefault(value, []).append(i)
+
+        partitions, lexicon, blobs, offset = {}, {}, [], 0
+        for value, positions in groups.items():
+            lists = {}
+            for local, i in enumerate(positions):
+                for term, tf in counts[i].items():
+                    lists.setdefault(term, []).append((local, tf))
+            # One encode call per partition; each term's slice is found from the per-value byte sizes
+            terms, flat = list(lists), []
+            for term in terms:
+                previous = 0
+                for local, tf in lists[term]:
+                    flat += (local - previous, tf)
+                    previous = local
+            encoded, sizes = encode_varints(flat)
+            ends = np.cumsum(sizes)
+            entries, value_pos = {}, 0
+            for term in terms:
+                start = int(ends[value_pos - 1]) if value_pos else 0
+                value_pos += 2 * len(lists[term])
+                entries[term] = (offset + start, int(ends[value_pos - 1]) - start)
+            partitions[value] = np.asarray(positions, dtype=np.int64)
+            lexicon[value] = entries
+            blobs.append(encoded)
+            offset += len(encoded)
+        postings = np.concatenate(blobs) if blobs else np.empty(0, dtype=np.uint8)
+        return cls({c: df[c].tolist() for c in columns}, doc_len, partitions, postings, lexicon, dict(doc_freq),
+                   k1, b, partition_column)
+
+    @classmethod
+    def from_table(cls, table_name, columns=("id", "state", "url", "content"), spark=None, **kwargs):
+        from pyspark.sql import SparkSession
+        spark = spark or SparkSession.getActiveSession()
+        return cls.from_pandas(spark.table(table_name).select(*columns).toPandas(), columns, **kwargs)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "postings.npy"), self.postings)
+        np.save(os.path.join(path, "doc_len.npy"), self.doc_len)
+        # Partition values can be anything JSON keys can't, so they are kept in a list
+        values = list(self.partitions)
+        np.savez(os.path.join(path, "partitions.npz"), *[self.partitions[v] for v in values])
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"k1": self.k1, "b": self.b, "partition_column": self.partition_column, "values": values,
+                       "lexicon": [self.lexicon[v] for v in values], "doc_freq": self.doc_freq, "rows": self.rows}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        with np.load(os.path.join(path, "partitions.npz")) as npz:
+            partitions = {v: npz[f"arr_{i}"] for i, v in enumerate(meta["values"])}
+        lexicon = {v: {t: tuple(e) for t, e in entries.items()} for v, entries in zip(meta["values"], meta["lexicon"])}
+        return cls(meta["rows"], np.load(os.path.join(path, "doc_len.npy")), partitions,
+                   np.load(os.path.join(path, "postings.npy"), mmap_mode="r" if mmap else None), lexicon,
+                   meta["doc_freq"], meta["k1"], meta["b"], meta["partition_column"])
+
+    def nbytes(self):
+        # Compressed posting bytes vs the same (doc id, tf) pairs as two int32 arrays
+        pairs = sum(self.doc_freq.values())
+        return {"postings_bytes": int(self.postings.nbytes), "int32_postings_bytes": 8 * pairs}
+
+    def idf(self, term):
+        df = self.doc_freq.get(term, 0)
+        return math.log(1 + (len(self.doc_len) - df + 0.5) / (df + 0.5))
+
+    def score(self, query_text, filters=None):
+        # (global row positions, BM25 scores) of the rows matching at least one query term
+        filters = dict(filters or {})
+        wanted = filters.pop(self.partition_column, None)
+        if wanted is None:
+            values = list(self.partitions)
+        else:
+            values = [v for v in (wanted if isinstance(wanted, (list, tuple, set)) else [wanted]) if v in self.partitions]
+        ids, scores = [], []
+        for term in set(tokenize(query_text)):
+            idf = self.idf(term)
+            for value in values:
+                entry = self.lexicon[value].get(term)
+                if entry is None:
+                    continue
+                pairs = decode_varints(self.postings[entry[0]:entry[0] + entry[1]])
+                rows = self.partitions[value][np.cumsum(pairs[0::2])]
+                tf = pairs[1::2].astype(np.float32)
+                norm = self.k1 * (1 - self.b + self.b * self.doc_len[rows] / self.avg_doc_len)
+                ids.append(rows)
+                scores.append(idf * tf * (self.k1 + 1) / (tf + norm))
+        if not ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        rows, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(scores)).astype(np.float32)
+        # Filters on other columns are applied to the matches
+        for col, value in filters.items():
+            allowed = set(value if isinstance(value, (list, tuple, set)) else [value])
+            keep = np.asarray([self.rows[col][i] in allowed for i in rows], dtype=bool)
+            rows, totals = rows[keep], totals[keep]
+        return rows, totals
+
+    def similarity_search(self, query_vector=None, columns=(), filters=None, num_results=10, query_text=None):
+        # Same call and result layout as the vector indexes; only query_text is used
+        if query_text is None:
+            raise ValueError("BM25Index.similarity_search needs query_text")
+        rows, scores = self.score(query_text, filters)
+        k = min(num_results, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k] if k else np.empty(0, dtype=np.int64)
+        top = top[np.argsort(-scores[top])]
+        data_array = [[self.rows[c][rows[i]] for c in columns] + [float(scores[i])] for i in top]
+        return {
+            "manifest": {"column_count": len(columns) + 1, "columns": [{"name": c} for c in columns] + [{"name": "score"}]},
+            "result": {"row_count": len(data_array), "data_array": data_array},
+        }
+
+
+def build_lexical_index(chunk_table, path=default_lexical_index_path, spark=None):
+    # Rebuilt from the chunk table after each ingest (e.g. in incremental_ingest's sync_index callback)
+    index = BM25Index.from_table(chunk_table, spark=spark)
+    if path:
+        index.save(path)
+    return index
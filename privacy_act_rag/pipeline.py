@@ -0,0 +1,357 @@
+# The query side of the chatbot as one object. Every component (clients, indexes, reranker, generator, caches)
+# is built on first use and kept for the lifetime of the object, so a long-running process pays for it once.
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from privacy_act_rag import tracing
+from privacy_act_rag.embeddings import (ada_embed_model, bge_embed_model, cached_embeddings, chunk_hash, embed_ada,
+                                        embed_bge, embed_query, get_ada_client, get_bge_embeddings)
+from privacy_act_rag.generation import pack_context
+from privacy_act_rag.lexical import default_lexical_index_path
+from privacy_act_rag.resources import get_worker_resource, load_chunk_tokenizer, worker_resource_timings
+from privacy_act_rag.states import chat_endpoint, detect_state_filters, us_states
+
+answer_prompt = '''Answer the question using only the documents below.
+Question: {query}
+
+{context}'''
+
+
+@dataclass
+class RAGConfig:
+    bge_endpoint_name: str = "bge_vector_search"
+    bge_index_name: str = "demo.hackathon.bge_self_managed_index"
+    ada_endpoint_name: str = "ada_vector_search"
+    ada_index_name: str = "demo.hackathon.ada_self_managed_index"
+    # Source of the state values the filters are validated against (when indexed_states is not given)
+    chunk_table: str = 'demo.hackathon.databricks_pdf_documentation_baai'
+    indexed_states: list = None
+    # Local BM25 index over chunk_table, the lexical third leg of the retrieval (built from the table when the
+    # path holds none yet; without Spark or with use_lexical_index=False only the vector legs run)
+    use_lexical_index: bool = True
+    lexical_index_path: str = default_lexical_index_path
+    reranker_model: str = "BAAI/bge-reranker-large"
+    chat_endpoint: str = chat_endpoint
+    # Rows per leg; with the lexical leg recalling the exact-term matches both can stay small
+    num_results: int = 8
+    # Fused candidates the cross-encoder scores, in fusion order
+    rerank_candidates: int = 12
+    context_token_budget: int = 3000
+    max_tokens: int = 1500
+    temperature: float = 0.8
+    answer_prompt: str = answer_prompt
+    use_answer_cache: bool = True
+    # answer_batch goes stage by stage over the whole batch: state detection and retrieval run batch_concurrency
+    # queries at a time, generation keeps generation_concurrency requests in flight and the reranker scores the
+    # pairs of rerank_batch_queries queries together (query embeddings follow the dispatchers' own limits)
+    batch_concurrency: int = 4
+    generation_concurrency: int = 8
+    rerank_batch_queries: int = 32
+
+
+class PrivacyActRAG:
+    def __init__(self, config=None, azure_openai_api_key=None, vsc_bge=None, vsc_ada=None, lexical_index=None):
+        # vsc_bge / vsc_ada replace the VectorSearchClients (e.g. LocalVectorSearchClient for offline runs),
+        # lexical_index the BM25Index otherwise loaded from config.lexical_index_path
+        self.config = config or RAGConfig()
+        self.azure_openai_api_key = azure_openai_api_key
+        self.components = {}
+        self.component_timings = {}
+        self.stats = {"queries": 0, "cached": 0, "latency_s": 0.0}
+        self.lock = threading.RLock()
+        if vsc_bge is not None:
+            self.components["vsc_bge"] = vsc_bge
+        if vsc_ada is not None:
+            self.components["vsc_ada"] = vsc_ada
+        if lexical_index is not None:
+            self.components["lexical_index"] = lexical_index
+
+    def component(self, name, factory):
+        if name not in self.components:
+            with self.lock:
+                if name not in self.components:
+                    start = time.perf_counter()
+                    self.components[name] = factory()
+                    self.component_timings[name] = time.perf_counter() - start
+        return self.components[name]
+
+    @property
+    def vsc_bge(self):
+        return self.component("vsc_bge", self._vector_search_client)
+
+    @property
+    def vsc_ada(self):
+        return self.component("vsc_ada", self._vector_search_client)
+
+    @staticmethod
+    def _vector_search_client():
+        from databricks.vector_search.client import VectorSearchClient
+        return VectorSearchClient(disable_notice=True)
+
+    @property
+    def retriever(self):
+        def load():
+            from privacy_act_rag.retrieval import Retriever
+            legs = {
+                "bge": (self.embed_bge, self.vsc_bge.get_index(self.config.bge_endpoint_name, self.config.bge_index_name)),
+                "ada": (self.embed_ada, self.vsc_ada.get_index(self.config.ada_endpoint_name, self.config.ada_index_name)),
+            }
+            if self.lexical_index is not None:
+                legs["bm25"] = (None, self.lexical_index)
+            return Retriever(legs, num_results=self.config.num_results,
+                             max_workers=len(legs) * self.config.batch_concurrency)
+        return self.component("retriever", load)
+
+    @property
+    def lexical_index(self):
+        def load():
+            if not self.config.use_lexical_index:
+                return None
+            from privacy_act_rag.lexical import BM25Index, build_lexical_index
+            path = self.config.lexical_index_path
+            if path and os.path.exists(os.path.join(path, "meta.json")):
+                return BM25Index.load(path)
+            spark = self._spark()
+            if spark is None:
+                return None
+            return build_lexical_index(self.config.chunk_table, path, spark)
+        return self.component("lexical_index", load)
+
+    @property
+    def reranker(self):
+        def load():
+            # torch / transformers are only imported by the first query that reranks
+            from privacy_act_rag.rerank import BGEReranker
+            return BGEReranker(self.config.reranker_model)
+        return self.component("reranker", load)
+
+    @property
+    def generator(self):
+        def load():
+            from privacy_act_rag.generation import MixtralGenerator
+            return MixtralGenerator(self.config.chat_endpoint)
+        return self.component("generator", load)
+
+    @property
+    def answer_cache(self):
+        def load():
+            from privacy_act_rag.answer_cache import SemanticAnswerCache, current_index_version
+            # Outside Spark there is no table version to follow, the TTL is the only invalidation then
+            version_fn = current_index_version if self._spark() is not None else None
+            return SemanticAnswerCache(version_fn=version_fn)
+        return self.component("answer_cache", load)
+
+    @property
+    def indexed_states(self):
+        def load():
+            if self.config.indexed_states is not None:
+                return list(self.config.indexed_states)
+            spark = self._spark()
+            if spark is None:
+                return list(us_states)
+            return sorted(r.state for r in spark.table(self.config.chunk_table).select("state").distinct().collect())
+        return self.component("indexed_states", load)
+
+    @staticmethod
+    def _spark():
+        try:
+            from pyspark.sql import SparkSession
+        except ImportError:
+            return None
+        return SparkSession.getActiveSession()
+
+    def embed_bge(self, query):
+        return get_bge_embeddings(query)
+
+    def embed_ada(self, query):
+        ada_client = get_ada_client(self.azure_openai_api_key)
+        return embed_query(ada_embed_model, query, lambda texts, errors: embed_ada(texts, ada_client, errors))
+
+    def embed_queries(self, queries):
+        # One bulk call per embedding model (batched and rate limited by the dispatchers) -> ({leg: vectors},
+        # {query position: error}) with None vectors for the failed queries
+        ada_client = get_ada_client(self.azure_openai_api_key)
+        models = {"bge": (bge_embed_model, embed_bge),
+                  "ada": (ada_embed_model, lambda texts, errors: embed_ada(texts, ada_client, errors))}
+        errors = {}
+
+        def run(model, embed_fn):
+            model_errors = {}
+            vectors = cached_embeddings(model, queries, lambda texts: embed_fn(texts, errors=model_errors))
+            for i, (query, vector) in enumerate(zip(queries, vectors)):
+                if vector is None:
+                    errors.setdefault(i, f"embedding with {model} failed: {model_errors.get(chunk_hash(query))}")
+            return vectors
+
+        with ThreadPoolExecutor(max_workers=len(models)) as pool:
+            futures = {leg: pool.submit(run, model, embed_fn) for leg, (model, embed_fn) in models.items()}
+            return {leg: f.result() for leg, f in futures.items()}, errors
+
+    def detect_states(self, query):
+        return detect_state_filters(query, self.indexed_states)
+
+    def warm_up(self):
+        # Build everything a query needs so the first request doesn't pay for it
+        start = time.perf_counter()
+        self.indexed_states, self.retriever, self.generator
+        self.reranker.load()
+        get_worker_resource("llama_tokenizer", load_chunk_tokenizer)
+        if self.config.use_answer_cache:
+            self.answer_cache
+        return time.perf_counter() - start
+
+    @tracing.traced("answer")
+    def answer(self, query):
+        start = time.perf_counter()
+        timings = {}
+
+        def lap(stage, t0):
+            timings[f"{stage}_s"] = time.perf_counter() - t0
+            return time.perf_counter()
+
+        t = time.perf_counter()
+        filters = self.detect_states(query)
+        t = lap("states", t)
+        query_vector = None
+        if self.config.use_answer_cache:
+            # Same vector the BGE retrieval leg uses, it comes back from the embedding cache there
+            query_vector = self.embed_bge(query)
+            cached = self.answer_cache.lookup(query_vector, filters)
+            t = lap("cache_lookup", t)
+            if cached is not None:
+                tracing.count("answer_cache.hits")
+                return self._record({**cached, "query": query, "cached": True, "timings": timings}, start)
+
+        # The BGE leg reuses the vector of the cache lookup
+        retrieved = self.retriever.retrieve(query, filters,
+                                            query_vectors={"bge": query_vector} if query_vector is not None else None)
+        t = lap("retrieve", t)
+        reranked = self.reranker.rerank(query, retrieved["docs"], max_candidates=self.config.rerank_candidates)
+        t = lap("rerank", t)
+        packed = pack_context(reranked, self.config.context_token_budget)
+        t = lap("pack", t)
+        answer = self.generator.generate(self.config.answer_prompt.format(query=query, context=packed["context"]),
+                                         context_ids=[d[0] for d in packed["docs"]],
+                                         max_tokens=self.config.max_tokens, temperature=self.config.temperature)
+        lap("generate", t)
+        result = {"query": query, "answer": answer, "filters": filters, "docs": packed["docs"],
+                  "context_tokens": packed["tokens"]}
+        if self.config.use_answer_cache:
+            self.answer_cache.put(query_vector, filters, result, time.perf_counter() - start)
+        return self._record({**result, "cached": False, "timings": timings}, start)
+
+    def _record(self, result, start=None):
+        if start is not None:
+            result["latency_s"] = time.perf_counter() - start
+        with self.lock:
+            self.stats["queries"] += 1
+            self.stats["cached"] += result["cached"]
+            self.stats["latency_s"] += result["latency_s"]
+        return result
+
+    @tracing.traced("answer_batch")
+    def answer_batch(self, queries):
+        # Stage by stage over the whole batch instead of query by query: state detection, bulk query embedding,
+        # answer cache, retrieval, cross-query reranking, context packing and generation. Results come back in
+        # input order with per-query timings (a bulk stage's wall time is split evenly over its queries) and
+        # latency_s as their sum; a query that fails carries an error instead of failing the batch.
+        queries = list(queries)
+        timings = [{} for _ in queries]
+        errors = {}
+
+        def each(stage, fn, positions, concurrency):
+            def run(i):
+                t0 = time.perf_counter()
+                try:
+                    return fn(i)
+                except Exception as e:
+                    errors[i] = f"{stage}: {e!r}"
+                finally:
+                    timings[i][f"{stage}_s"] = time.perf_counter() - t0
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                return dict(zip(positions, pool.map(run, positions)))
+
+        def bulk(stage, fn, positions):
+            t0 = time.perf_counter()
+            try:
+                return fn(positions)
+            except Exception as e:
+                errors.update({i: f"{stage}: {e!r}" for i in positions})
+            finally:
+                for i in positions:
+                    timings[i][f"{stage}_s"] = (time.perf_counter() - t0) / len(positions)
+
+        def pending(positions):
+            return [i for i in positions if i not in errors]
+
+        live = list(range(len(queries)))
+        filters = each("states", lambda i: self.detect_states(queries[i]), live, self.config.batch_concurrency)
+        live = pending(live)
+        vectors = {}
+        if live:
+            embedded = bulk("embed", lambda ps: self.embed_queries([queries[i] for i in ps]), live)
+            if embedded is not None:
+                legs, embed_errors = embedded
+                vectors = {i: {leg: v[n] for leg, v in legs.items()} for n, i in enumerate(live)}
+                errors.update({live[n]: f"embed: {e}" for n, e in embed_errors.items()})
+        live = pending(live)
+
+        cached = {}
+        if self.config.use_answer_cache:
+            for i in live:
+                t0 = time.perf_counter()
+                hit = self.answer_cache.lookup(vectors[i]["bge"], filters[i])
+                timings[i]["cache_lookup_s"] = time.perf_counter() - t0
+                if hit is not None:
+                    cached[i] = hit
+            tracing.count("answer_cache.hits", len(cached))
+            live = [i for i in live if i not in cached]
+
+        retrieved = each("retrieve", lambda i: self.retriever.retrieve(queries[i], filters[i], query_vectors=vectors[i]),
+                         live, self.config.batch_concurrency)
+        live = pending(live)
+        reranked = {}
+        step = self.config.rerank_batch_queries
+        for part in (live[n:n + step] for n in range(0, len(live), step)):
+            scored = bulk("rerank", lambda ps: self.reranker.rerank_many(
+                [queries[i] for i in ps], [retrieved[i]["docs"] for i in ps], max_candidates=self.config.rerank_candidates), part)
+            if scored is not None:
+                reranked.update(zip(part, scored))
+        live = pending(live)
+        packed = each("pack", lambda i: pack_context(reranked[i], self.config.context_token_budget), live, 1)
+        live = pending(live)
+        answers = each("generate", lambda i: self.generator.generate(
+            self.config.answer_prompt.format(query=queries[i], context=packed[i]["context"]),
+            context_ids=[d[0] for d in packed[i]["docs"]],
+            max_tokens=self.config.max_tokens, temperature=self.config.temperature), live, self.config.generation_concurrency)
+
+        results = []
+        for i, query in enumerate(queries):
+            if i in errors:
+                result = {"query": query, "answer": None, "filters": filters.get(i), "docs": [], "context_tokens": 0,
+                          "cached": False, "error": errors[i]}
+                tracing.count("answer_batch.errors")
+            elif i in cached:
+                result = {**cached[i], "query": query, "cached": True}
+            else:
+                result = {"query": query, "answer": answers[i], "filters": filters[i], "docs": packed[i]["docs"],
+                          "context_tokens": packed[i]["tokens"], "cached": False}
+                if self.config.use_answer_cache:
+                    self.answer_cache.put(vectors[i]["bge"], filters[i], result, sum(timings[i].values()))
+            results.append(self._record({**result, "timings": timings[i], "latency_s": sum(timings[i].values())}))
+        return results
+
+    def metrics(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["mean_latency_s"] = stats["latency_s"] / stats["queries"] if stats["queries"] else 0.0
+        metrics = {"queries": stats, "component_load_s": dict(self.component_timings),
+                   "worker_resource_load_s": worker_resource_timings()}
+        if "answer_cache" in self.components:
+            metrics["answer_cache"] = self.answer_cache.metrics()
+        if tracing.is_enabled():
+            metrics["tracing"] = tracing.snapshot()
+        return metrics
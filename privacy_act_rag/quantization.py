@@ -0,0 +1,46 @@
+# Compact embedding storage: float16 or int8 codes with a float32 scale per vector, packed into one binary value
+# (4 byte scale + codes), so a 1024-d BGE vector takes 2052 / 1028 bytes instead of 4096.
+#   int8:    x ~= scale * codes, scale = max|x| / 127
+#   float16: x ~= scale * codes, scale = |x| and codes the unit vector
+import numpy as np
+
+quantized_dtypes = {"int8": np.int8, "float16": np.float16}
+
+
+def quantize_vectors(mat, dtype="int8"):
+    # (n, d) float array -> (codes, scales)
+    mat = np.asarray(mat, dtype=np.float32)
+    if dtype == "int8":
+        scales = np.abs(mat).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.clip(np.rint(mat / scales[:, None]), -127, 127).astype(np.int8)
+    elif dtype == "float16":
+        scales = np.linalg.norm(mat, axis=1)
+        scales[scales == 0] = 1
+        codes = (mat / scales[:, None]).astype(np.float16)
+    else:
+        raise ValueError(f"unsupported quantized dtype {dtype!r}, expected one of {sorted(quantized_dtypes)}")
+    return codes, scales.astype(np.float32)
+
+
+def dequantize_vectors(codes, scales):
+    return codes.astype(np.float32) * scales[:, None]
+
+
+def encode_vectors(vectors, dtype="int8"):
+    # List of vectors (None stays None) -> list of bytes values for a BINARY column
+    present = [i for i, v in enumerate(vectors) if v is not None]
+    out = [None] * len(vectors)
+    if present:
+        codes, scales = quantize_vectors([vectors[i] for i in present], dtype)
+        for i, code, scale in zip(present, codes, scales):
+            out[i] = scale.tobytes() + code.tobytes()
+    return out
+
+
+def decode_vectors(blobs, dtype="int8"):
+    # Inverse of encode_vectors for non-null values of one dtype -> (codes, scales)
+    raw = np.frombuffer(b"".join(blobs), dtype=np.uint8).reshape(len(blobs), -1)
+    scales = raw[:, :4].copy().view(np.float32).ravel()
+    codes = raw[:, 4:].copy().view(quantized_dtypes[dtype])
+    return codes, scales
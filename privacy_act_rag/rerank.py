@@ -0,0 +1,102 @@
+# Cross-encoder reranking of the fused candidates
+import heapq
+import threading
+from collections import OrderedDict
+
+import torch
+# Load model directly
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+from privacy_act_rag import tracing
+
+
+class BGEReranker:
+    # Long-lived cross-encoder: the model is loaded once (lazily), pairs are scored in batches of similar token
+    # length and scores are cached per (query, chunk id).
+    # quantize=None picks dynamic int8 Linear layers on CPU hosts and fp16 on GPU (fp16 does nothing on CPU).
+    def __init__(self, model_name="BAAI/bge-reranker-large", quantize=None, max_batch_size=16,
+                 max_batch_tokens=8192, max_length=512, cache_size=10000):
+        self.model_name = model_name
+        self.quantize = (not torch.cuda.is_available()) if quantize is None else quantize
+        self.max_batch_size = max_batch_size
+        # Padded tokens per forward pass (batch size x longest pair)
+        self.max_batch_tokens = max_batch_tokens
+        self.max_length = max_length
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.tokenizer = None
+        self.model = None
+
+    def load(self):
+        if self.model is None:
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            model = AutoModelForSequenceClassification.from_pretrained(self.model_name).eval()
+            if self.quantize:
+                model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            elif torch.cuda.is_available():
+                model = model.half().to("cuda")
+            self.model = model
+        return self.model
+
+    def score_pairs(self, pairs):
+        model = self.load()
+        device = "cuda" if not self.quantize and torch.cuda.is_available() else "cpu"
+        # Tokenise once without padding, then pad per batch so short pairs don't pay for the longest one
+        encodings = self.tokenizer([q for q, _ in pairs], [p for _, p in pairs], truncation=True, max_length=self.max_length)
+        lengths = [len(ids) for ids in encodings["input_ids"]]
+        scores = [0.0] * len(pairs)
+
+        def run(batch):
+            features = self.tokenizer.pad([{k: encodings[k][i] for k in encodings.keys()} for i in batch], return_tensors="pt")
+            with tracing.span("rerank_batch", pairs=len(batch), padded_tokens=int(features["input_ids"].numel())):
+                with torch.inference_mode():
+                    logits = model(**features.to(device)).logits.view(-1).float()
+            tracing.count("rerank.pairs", len(batch))
+            for i, score in zip(batch, logits.tolist()):
+                scores[i] = score
+
+        batch = []
+        for i in sorted(range(len(pairs)), key=lengths.__getitem__):
+            # Sorted by length, so the pair being added is the longest of the batch
+            if batch and (len(batch) >= self.max_batch_size or (len(batch) + 1) * lengths[i] > self.max_batch_tokens):
+                run(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            run(batch)
+        return scores
+
+    def rerank(self, query, docs, top_k=None, max_candidates=None, id_index=0, content_index=3):
+        # docs come in fused retrieval order: only the first max_candidates are scored and the top_k best are
+        # returned as (row, score), best first
+        return self.rerank_many([query], [docs], top_k, max_candidates, id_index, content_index)[0]
+
+    def rerank_many(self, queries, docs_lists, top_k=None, max_candidates=None, id_index=0, content_index=3):
+        # rerank() for several queries at once: the uncached pairs of all of them are scored together, so the
+        # length-sorted batches stay full
+        candidates = [docs[:max_candidates] if max_candidates else list(docs) for docs in docs_lists]
+        keys = [[(query, d[id_index]) for d in docs] for query, docs in zip(queries, candidates)]
+        total = sum(len(docs) for docs in candidates)
+        with tracing.span("rerank", queries=len(queries), candidates=total) as s, self.lock:
+            missing = {}
+            # A single candidate is scored too: callers threshold and trace the scores
+            for docs, doc_keys in zip(candidates, keys):
+                for d, k in zip(docs, doc_keys):
+                    if k not in self.cache:
+                        missing.setdefault(k, (k[0], d[content_index]))
+            s.set(scored=len(missing))
+            tracing.count("rerank.cache_hits", total - len(missing))
+            if missing:
+                for k, score in zip(missing, self.score_pairs(list(missing.values()))):
+                    self.cache[k] = score
+            results = []
+            for docs, doc_keys in zip(candidates, keys):
+                scored = []
+                for d, k in zip(docs, doc_keys):
+                    self.cache.move_to_end(k)
+                    scored.append((d, self.cache[k]))
+                results.append(heapq.nlargest(top_k or len(scored), scored, key=lambda x: x[1]))
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return results
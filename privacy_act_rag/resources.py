@@ -0,0 +1,84 @@
+# Process-level resources shared by the UDFs, the parsing workers and the query pipeline
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# This module is imported (not pickled) on the executors, so these live as long as the reused Python worker
+_resources = {}
+_timings = {}
+_lock = threading.Lock()
+
+# HF models and tokenizers are cached on the local disk
+os.environ.setdefault("HF_HOME", '/tmp')
+
+
+def get_worker_resource(name, factory):
+    # Build the resource on first use in this process and hand back the same object afterwards
+    if name not in _resources:
+        with _lock:
+            if name not in _resources:
+                start = time.perf_counter()
+                _resources[name] = factory()
+                _timings[name] = time.perf_counter() - start
+                logging.info(f"worker resource {name} loaded in {_timings[name]:.3f}s (pid {os.getpid()})")
+    return _resources[name]
+
+
+def set_worker_resource(name, value):
+    # Pre-register a resource (e.g. a stand-in client for offline runs) so get_worker_resource never builds it
+    with _lock:
+        _resources[name] = value
+        _timings.setdefault(name, 0.0)
+
+
+@contextmanager
+def restored_worker_resources():
+    # Stand-ins registered inside the block (offline runs, benchmarks) only live for the block: on exit the
+    # registry is put back as it was, so real clients, rate limits and caches of the process come back
+    with _lock:
+        resources, timings = dict(_resources), dict(_timings)
+    try:
+        yield
+    finally:
+        with _lock:
+            _resources.clear()
+            _resources.update(resources)
+            _timings.clear()
+            _timings.update(timings)
+
+
+def worker_resource_timings():
+    # Seconds spent building each resource in this process, e.g. {"llama_tokenizer": 1.8, ...}
+    return dict(_timings)
+
+
+def load_chunk_tokenizer():
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained("hf-internal-testing/llama-tokenizer", cache_dir = '/tmp')
+
+
+def load_sentence_splitter():
+    from llama_index.node_parser import SentenceSplitter
+    #Sentence splitter from llama_index to split on sentences
+    return SentenceSplitter(chunk_size=500, chunk_overlap=25)
+
+
+def load_partitioner():
+    # The PDF partitioner drags in pdfminer and the unstructured inference stack, import it once per worker
+    import unstructured.partition.pdf
+    from unstructured.partition.auto import partition
+    return partition
+
+
+def get_chunk_splitter():
+    from llama_index import set_global_tokenizer
+    #set llama2 as tokenizer to match our model size (will stay below BGE 1024 limit)
+    # Tokenizer and splitter are loaded once per Python worker, not once per task
+    set_global_tokenizer(get_worker_resource("llama_tokenizer", load_chunk_tokenizer))
+    # splitter = SemanticSplitterNodeParser(
+    # buffer_size=1, breakpoint_percentile_threshold=95, embed_model=embeddings
+    # )
+    # Built after set_global_tokenizer since the splitter picks up the global tokenizer
+    return get_worker_resource("sentence_splitter", load_sentence_splitter)
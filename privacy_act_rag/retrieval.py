@@ -0,0 +1,243 @@
+# First-stage retrieval: the local vector index stand-in and the concurrent vector + BM25 search with rank fusion
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from privacy_act_rag import tracing
+from privacy_act_rag.quantization import decode_vectors, quantize_vectors
+
+retrieval_columns = ["id", "state", "url", "content"]
+
+
+class LocalVectorIndex:
+    # In-process brute-force index answering similarity_search like a Databricks vector search index.
+    # Embeddings are L2-normalised once so the score is the cosine similarity. The scanned matrix can be float32,
+    # float16 or int8 codes (row_scales turns an int8 dot product back into a cosine) and can be a read-only
+    # memmap (see save/load). With a full-precision copy (full, memmapped after load) the best
+    # rescore_factor * num_results compact candidates are re-scored exactly and only those rows are read.
+    def __init__(self, embeddings, rows, posting_columns=("state",), row_scales=None, full=None, rescore_factor=4,
+                 block_rows=256):
+        self.embeddings = embeddings
+        self.rows = rows
+        self.row_scales = row_scales
+        self.full = full
+        self.rescore_factor = rescore_factor
+        self.block_rows = block_rows
+        # Precomputed posting lists (value -> row positions) for the columns we filter on
+        self.postings = {}
+        for col in posting_columns:
+            lists = {}
+            for i, value in enumerate(rows[col]):
+                lists.setdefault(value, []).append(i)
+            self.postings[col] = {k: np.asarray(v, dtype=np.int64) for k, v in lists.items()}
+
+    @classmethod
+    def from_pandas(cls, df, embedding_col, columns=("id", "state", "url", "content"), dtype=np.float32, keep_full=None):
+        # dtype: float32, float16 or int8 for the scanned matrix. keep_full (default: whenever dtype is compact)
+        # keeps a float32 copy for re-scoring.
+        mat = np.asarray(df[embedding_col].tolist(), dtype=np.float32)
+        norms = np.linalg.norm(mat, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        mat /= norms
+        dtype = np.dtype(dtype).name
+        keep_full = dtype != "float32" if keep_full is None else keep_full
+        row_scales = None
+        if dtype == "int8":
+            embeddings, row_scales = quantize_vectors(mat, "int8")
+        else:
+            embeddings = mat.astype(dtype)
+        return cls(embeddings, {c: df[c].tolist() for c in columns}, row_scales=row_scales,
+                   full=mat if keep_full and dtype != "float32" else None)
+
+    @classmethod
+    def from_quantized_pandas(cls, df, quantized_col, dtype="int8", columns=("id", "state", "url", "content"), full_col=None):
+        # From a BINARY column written by ingest.compact_embeddings; full_col (ARRAY<FLOAT>) enables re-scoring
+        codes, _ = decode_vectors(df[quantized_col].tolist(), dtype)
+        # Stored codes are not unit length: 1 / |codes| makes the dot product a cosine again
+        norms = np.linalg.norm(codes.astype(np.float32), axis=1)
+        norms[norms == 0] = 1
+        full = None
+        if full_col is not None:
+            full = np.asarray(df[full_col].tolist(), dtype=np.float32)
+            full /= np.maximum(np.linalg.norm(full, axis=1, keepdims=True), 1e-12)
+        return cls(codes, {c: df[c].tolist() for c in columns}, row_scales=(1 / norms).astype(np.float32), full=full)
+
+    @classmethod
+    def from_table(cls, table_name, embedding_col, columns=("id", "state", "url", "content"), dtype=np.float32, spark=None,
+                   quantized_col=None, keep_full=None):
+        # quantized_col reads the compact column instead (plus embedding_col for re-scoring when keep_full)
+        from pyspark.sql import SparkSession
+        spark = spark or SparkSession.getActiveSession()
+        if quantized_col is None:
+            return cls.from_pandas(spark.table(table_name).select(*columns, embedding_col).toPandas(), embedding_col,
+                                   columns, dtype, keep_full)
+        full_col = embedding_col if keep_full else None
+        df = spark.table(table_name).select(*columns, quantized_col, *([full_col] if full_col else [])).toPandas()
+        return cls.from_quantized_pandas(df, quantized_col, np.dtype(dtype).name, columns, full_col)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "embeddings.npy"), self.embeddings)
+        for name in ("row_scales", "full"):
+            if getattr(self, name) is not None:
+                np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(path, "rows.json"), "w") as f:
+            json.dump(self.rows, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        mode = "r" if mmap else None
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mode)
+                  for name in ("embeddings", "row_scales", "full") if os.path.exists(os.path.join(path, f"{name}.npy"))}
+        with open(os.path.join(path, "rows.json")) as f:
+            return cls(arrays["embeddings"], json.load(f), row_scales=arrays.get("row_scales"), full=arrays.get("full"))
+
+    def nbytes(self):
+        # Bytes touched by a full scan vs the full-precision copy only read for re-scoring
+        return {"scan_bytes": self.embeddings.nbytes + (self.row_scales.nbytes if self.row_scales is not None else 0),
+                "full_bytes": self.full.nbytes if self.full is not None else 0}
+
+    def _candidates(self, filters):
+        # None means every row
+        candidates = None
+        for col, values in (filters or {}).items():
+            values = values if isinstance(values, (list, tuple, set)) else [values]
+            if col in self.postings:
+                rows = [self.postings[col].get(v, np.empty(0, dtype=np.int64)) for v in values]
+                rows = np.unique(np.concatenate(rows)) if rows else np.empty(0, dtype=np.int64)
+            else:
+                wanted = set(values)
+                rows = np.asarray([i for i, v in enumerate(self.rows[col]) if v in wanted], dtype=np.int64)
+            candidates = rows if candidates is None else np.intersect1d(candidates, rows)
+        return candidates
+
+    def _compact_scores(self, positions, q):
+        # Block by block: a few hundred converted rows stay in cache, so an int8 scan runs about as fast as float32
+        # (numpy has no fast float16 -> float32 path, float16 mostly saves storage)
+        n = len(self.embeddings) if positions is None else len(positions)
+        scores = np.empty(n, dtype=np.float32)
+        for start in range(0, n, self.block_rows):
+            rows = slice(start, start + self.block_rows) if positions is None else positions[start:start + self.block_rows]
+            block = np.asarray(self.embeddings[rows])
+            scores[start:start + len(block)] = block.astype(np.float32, copy=False) @ q
+        if self.row_scales is not None:
+            scores *= self.row_scales if positions is None else self.row_scales[positions]
+        return scores
+
+    def similarity_search(self, query_vector, columns, filters=None, num_results=10):
+        q = np.asarray(query_vector, dtype=np.float32)
+        q /= np.linalg.norm(q) or 1
+        candidates = self._candidates(filters)
+        scores = self._compact_scores(candidates, q)
+        k = min(num_results * self.rescore_factor if self.full is not None else num_results, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k] if k else np.empty(0, dtype=np.int64)
+        positions = top if candidates is None else candidates[top]
+        top_scores = scores[top]
+        if self.full is not None and len(positions):
+            # Sorted positions so a memmapped copy is read front to back
+            order = np.argsort(positions)
+            top_scores = np.empty(len(positions), dtype=np.float32)
+            top_scores[order] = np.asarray(self.full[positions[order]], dtype=np.float32) @ q
+        best = np.argsort(-top_scores)[:num_results]
+        data_array = [[self.rows[c][i] for c in columns] + [float(score)] for i, score in zip(positions[best], top_scores[best])]
+        return {
+            "manifest": {"column_count": len(columns) + 1, "columns": [{"name": c} for c in columns] + [{"name": "score"}]},
+            "result": {"row_count": len(data_array), "data_array": data_array},
+        }
+
+    def sync(self):
+        # Local indexes are rebuilt with from_table, nothing to trigger
+        pass
+
+
+class LocalVectorSearchClient:
+    # Same get_index entry point as VectorSearchClient, backed by LocalVectorIndex objects keyed by index name
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    def get_index(self, endpoint_name=None, index_name=None):
+        return self.indexes[index_name]
+
+
+def recall_at_k(reference, candidate, query_vectors, k=10, filters=None, id_column="id"):
+    # Share of the reference top-k ids (e.g. a float32 LocalVectorIndex) that the candidate index (e.g. an int8
+    # one) also returns, plus the search latency of both; any object with similarity_search works on either side
+    recalls, times = [], {"reference": [], "candidate": []}
+    for q in query_vectors:
+        ids = {}
+        for name, index in (("reference", reference), ("candidate", candidate)):
+            start = time.perf_counter()
+            result = index.similarity_search(query_vector=list(q), columns=[id_column], filters=filters, num_results=k)
+            times[name].append(time.perf_counter() - start)
+            ids[name] = {row[0] for row in result["result"]["data_array"]}
+        if ids["reference"]:
+            recalls.append(len(ids["reference"] & ids["candidate"]) / len(ids["reference"]))
+    report = {"k": k, "queries": len(recalls),
+              "recall_at_k": float(np.mean(recalls)) if recalls else None,
+              "min_recall": float(np.min(recalls)) if recalls else None}
+    for name, index in (("reference", reference), ("candidate", candidate)):
+        report[f"{name}_p50_ms"] = float(np.percentile(times[name], 50) * 1000) if times[name] else None
+        if hasattr(index, "nbytes"):
+            report[f"{name}_bytes"] = index.nbytes()
+    return report
+
+
+def search_leg(embed_fn, index, query, filters, num_results, name="search"):
+    # embed_fn=None is a lexical leg (BM25Index): the index gets the query text instead of a vector
+    start = time.perf_counter()
+    with tracing.span("query_embed", leg=name):
+        query_args = {"query_vector": embed_fn(query)} if embed_fn is not None else {"query_text": query}
+    embedded = time.perf_counter()
+    with tracing.span("similarity_search", leg=name, num_results=num_results) as s:
+        results = index.similarity_search(
+            **query_args,
+            columns=retrieval_columns,
+            filters=filters,
+            num_results=num_results)
+        docs = results.get('result', {}).get('data_array', [])
+        s.set(rows=len(docs))
+    return docs, {"embed_s": embedded - start, "search_s": time.perf_counter() - embedded}
+
+
+def reciprocal_rank_fusion(result_lists, k=60, id_index=0):
+    # Rows are merged on their chunk id and each list adds 1 / (k + rank). The per-index score (last column)
+    # is replaced by the fused score, so rows keep the [id, state, url, content, score] layout.
+    fused, rows = {}, {}
+    for results in result_lists:
+        for rank, row in enumerate(results, start=1):
+            chunk_id = row[id_index]
+            fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (k + rank)
+            rows.setdefault(chunk_id, list(row[:-1]))
+    return [rows[i] + [score] for i, score in sorted(fused.items(), key=lambda x: x[1], reverse=True)]
+
+
+class Retriever:
+    # All legs (embedding + search) of a query run side by side; index handles are looked up once since
+    # get_index is a round trip of its own
+    def __init__(self, legs, num_results=10, max_workers=4):
+        # legs: {name: (embed_fn, index)}, embed_fn None for a lexical index
+        self.legs = legs
+        self.num_results = num_results
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def retrieve(self, query, filters=None, num_results=None, query_vectors=None):
+        # query_vectors: {leg: vector} already embedded (e.g. in bulk by answer_batch), those legs skip embed_fn
+        start = time.perf_counter()
+        num_results = num_results or self.num_results
+        query_vectors = query_vectors or {}
+        # An empty state list means no filter at all
+        filters = {k: v for k, v in (filters or {}).items() if v} or None
+        futures = {name: self.pool.submit(search_leg, (lambda _, v=query_vectors[name]: v) if name in query_vectors else embed_fn,
+                                          index, query, filters, num_results, name)
+                   for name, (embed_fn, index) in self.legs.items()}
+        results = {name: f.result() for name, f in futures.items()}
+        fusion_start = time.perf_counter()
+        with tracing.span("fusion", legs=len(results)):
+            docs = reciprocal_rank_fusion([docs for docs, _ in results.values()])
+        timings = {f"{name}_{stage}": t for name, (_, leg_timings) in results.items() for stage, t in leg_timings.items()}
+        timings["fusion_s"] = time.perf_counter() - fusion_start
+        timings["total_s"] = time.perf_counter() - start
+        return {"docs": docs, "legs": {name: docs for name, (docs, _) in results.items()}, "timings": timings}
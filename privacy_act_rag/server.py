@@ -0,0 +1,85 @@
+# Long-running query server: one PrivacyActRAG per process, warmed up before the first request is accepted.
+#   python -m privacy_act_rag.server --port 8000
+#   curl -XPOST localhost:8000/answer -d '{"query": "when does the Colorado act take effect"}'
+import argparse
+import json
+import logging
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from privacy_act_rag.pipeline import PrivacyActRAG
+
+
+def make_handler(rag):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status, payload):
+            body = json.dumps(payload, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/healthz":
+                self.send_json(200, {"status": "ok"})
+            elif self.path == "/metrics":
+                self.send_json(200, rag.metrics())
+            else:
+                self.send_json(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self):
+            start = time.perf_counter()
+            if self.path not in ("/answer", "/answer_batch"):
+                self.send_json(404, {"error": f"unknown path {self.path}"})
+                return
+            # Only a malformed request is a 400; anything the pipeline raises (a KeyError or ValueError included)
+            # is a 500
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path == "/answer":
+                    query = payload["query"]
+                    if not isinstance(query, str):
+                        raise ValueError("query must be a string")
+                else:
+                    queries = payload["queries"]
+                    if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+                        raise ValueError("queries must be a list of strings")
+            except (KeyError, TypeError, ValueError) as e:
+                self.send_json(400, {"error": f"bad request: {e!r}"})
+                return
+            try:
+                result = rag.answer(query) if self.path == "/answer" else rag.answer_batch(queries)
+            except Exception as e:
+                logging.exception("query failed")
+                self.send_json(500, {"error": repr(e)})
+                return
+            self.send_json(200, {"result": result, "server_latency_s": time.perf_counter() - start})
+
+        def log_message(self, format, *args):
+            logging.info("%s - %s", self.address_string(), format % args)
+
+    return Handler
+
+
+def serve(rag=None, host="127.0.0.1", port=8000, warm_up=True):
+    rag = rag or PrivacyActRAG()
+    if warm_up:
+        logging.info(f"warm-up took {rag.warm_up():.1f}s: {rag.component_timings}")
+    server = ThreadingHTTPServer((host, port), make_handler(rag))
+    logging.info(f"serving on {host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # Loopback only unless asked: the server has no authentication
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--no-warm-up", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    serve(host=args.host, port=args.port, warm_up=not args.no_warm_up)
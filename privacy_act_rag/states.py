@@ -0,0 +1,127 @@
+# US state detection for the retrieval filters: a local gazetteer, with the LLM only for ambiguous text
+import ast
+import json
+import logging
+import re
+
+from privacy_act_rag import tracing
+from privacy_act_rag.embeddings import get_deploy_client
+
+chat_endpoint = "databricks-mixtral-8x7b-instruct"
+
+
+def get_state_from_query(query, chat_endpoint=chat_endpoint):
+    client = get_deploy_client()
+    inputs = {
+        "messages": [
+            {
+                "role": "user",
+                "content": f"""
+                You determine if there are any US states present in this text: {query}.
+                Your response should be JSON like the following:
+                {{ 
+                    "state": []
+                }}
+
+                """
+            }
+        ],
+        "max_tokens": 64,
+        "temperature": 0
+    }
+
+    response = client.predict(endpoint=chat_endpoint, inputs=inputs)
+    return response["choices"][0]['message']['content']
+
+
+us_states = {
+    "Alabama": "AL", "Alaska": "AK", "Arizona": "AZ", "Arkansas": "AR", "California": "CA", "Colorado": "CO",
+    "Connecticut": "CT", "Delaware": "DE", "Florida": "FL", "Georgia": "GA", "Hawaii": "HI", "Idaho": "ID",
+    "Illinois": "IL", "Indiana": "IN", "Iowa": "IA", "Kansas": "KS", "Kentucky": "KY", "Louisiana": "LA",
+    "Maine": "ME", "Maryland": "MD", "Massachusetts": "MA", "Michigan": "MI", "Minnesota": "MN", "Mississippi": "MS",
+    "Missouri": "MO", "Montana": "MT", "Nebraska": "NE", "Nevada": "NV", "New Hampshire": "NH", "New Jersey": "NJ",
+    "New Mexico": "NM", "New York": "NY", "North Carolina": "NC", "North Dakota": "ND", "Ohio": "OH", "Oklahoma": "OK",
+    "Oregon": "OR", "Pennsylvania": "PA", "Rhode Island": "RI", "South Carolina": "SC", "South Dakota": "SD",
+    "Tennessee": "TN", "Texas": "TX", "Utah": "UT", "Vermont": "VT", "Virginia": "VA", "Washington": "WA",
+    "West Virginia": "WV", "Wisconsin": "WI", "Wyoming": "WY", "District of Columbia": "DC",
+}
+state_aliases = {
+    "Washington DC": "District of Columbia", "Washington D.C.": "District of Columbia", "D.C.": "District of Columbia",
+}
+# Short forms that are also everyday words ("mass surveillance", "wash my data"): matched capitalised only, and
+# like the ambiguous codes a match alone is not trusted
+short_state_aliases = {
+    "Cali": "California", "Calif": "California", "Mass": "Massachusetts", "Penn": "Pennsylvania", "Conn": "Connecticut",
+    "Jersey": "New Jersey", "Wash": "Washington",
+}
+# Two-letter codes that double as everyday upper-case words; matching one of these alone is not trusted
+ambiguous_abbreviations = {"AL", "CO", "DE", "HI", "ID", "IN", "LA", "MA", "MD", "ME", "OH", "OK", "OR", "PA"}
+
+_state_names = {name.lower(): state for name, state in [(s, s) for s in us_states] + list(state_aliases.items())}
+_state_abbreviations = {abbr: state for state, abbr in us_states.items()}
+# One precompiled pass: names and aliases case-insensitive (longest first so "West Virginia" wins over
+# "Virginia"), short aliases capitalised only, two-letter codes upper-case only
+_state_pattern = re.compile(
+    r"(?<!\w)(?:(?i:(?P<name>" + "|".join(re.escape(n).replace(r"\ ", r"\s+") for n in sorted(_state_names, key=len, reverse=True)) + "))"
+    r"|(?P<alias>" + "|".join(sorted(short_state_aliases, key=len, reverse=True)) + ")"
+    r"|(?P<abbr>" + "|".join(_state_abbreviations) + r"))(?!\w)"
+)
+
+
+def match_states(text):
+    # Returns (canonical state names, whether the text needs a second opinion)
+    states, ambiguous = set(), False
+    shouting = text.isupper()
+    for m in _state_pattern.finditer(text):
+        if m.group("name"):
+            states.add(_state_names[" ".join(m.group("name").lower().split())])
+        elif m.group("alias") or shouting or m.group("abbr") in ambiguous_abbreviations:
+            ambiguous = True
+        else:
+            states.add(_state_abbreviations[m.group("abbr")])
+    return states, ambiguous
+
+
+def canonical_state(value):
+    value = " ".join(str(value).split())
+    return (_state_names.get(value.lower()) or short_state_aliases.get(value.title())
+            or _state_abbreviations.get(value.upper()))
+
+
+def parse_state_response(response):
+    # Pull the first {...} out of the LLM reply and accept JSON or Python literal formatting
+    m = re.search(r"\{.*?\}", response, re.S)
+    if not m:
+        return []
+    try:
+        payload = json.loads(m.group(0))
+    except ValueError:
+        try:
+            payload = ast.literal_eval(m.group(0))
+        except (ValueError, SyntaxError):
+            return []
+    states = payload.get("state", []) if isinstance(payload, dict) else []
+    return [states] if isinstance(states, str) else [s for s in states if isinstance(s, str)]
+
+
+def resolve_indexed_states(states, indexed_states):
+    # Map canonical names onto the values stored in the index ("New_York", "new york", ...) and drop the
+    # states we have no documents for
+    def key(v):
+        return re.sub(r"[\s_\-]+", "", v).lower()
+    lookup = {key(v): v for v in indexed_states}
+    return sorted({lookup[key(s)] for s in states if key(s) in lookup})
+
+
+def detect_state_filters(query, indexed_states, llm_fallback=get_state_from_query):
+    states, ambiguous = match_states(query)
+    if ambiguous:
+        # A failing chat endpoint costs the ambiguous matches, not the query: the unambiguous ones still filter
+        try:
+            response = llm_fallback(query)
+        except Exception:
+            logging.exception("state detection fallback failed, keeping the gazetteer matches")
+            tracing.count("states.fallback_errors")
+            response = ""
+        states |= {c for c in map(canonical_state, parse_state_response(response)) if c}
+    return {"state": resolve_indexed_states(states, indexed_states)}
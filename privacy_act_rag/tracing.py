@@ -0,0 +1,315 @@
+# Spans, counters and histograms for the ingest and query paths.
+# Off unless PRIVACY_ACT_RAG_TRACE is set (to a JSONL path, "{pid}" is replaced by the process id, or to 1 for the
+# default path) or enable_tracing() is called. While off, span() hands back a shared no-op object and
+# count() / observe() return after a single flag check, so the instrumentation can stay in the hot paths.
+import atexit
+import functools
+import itertools
+import json
+import os
+import random
+import threading
+import time
+
+trace_env_var = "PRIVACY_ACT_RAG_TRACE"
+# One file per process: Spark Python workers and forked parsing workers never share a handle
+default_trace_path = "/local_disk0/tmp/privacy_act_rag_trace/{pid}.jsonl"
+# Samples kept per histogram for the percentiles (count / sum / min / max are exact)
+histogram_reservoir_size = 2048
+
+_enabled = False
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_exporter = None
+_local = threading.local()
+_span_ids = itertools.count(1)
+
+
+class Histogram:
+    __slots__ = ("count", "total", "min", "max", "samples")
+
+    def __init__(self):
+        self.count, self.total, self.min, self.max, self.samples = 0, 0.0, float("inf"), float("-inf"), []
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        # Uniform reservoir sampling over everything seen so far
+        if len(self.samples) < histogram_reservoir_size:
+            self.samples.append(value)
+        else:
+            j = random.randrange(self.count)
+            if j < histogram_reservoir_size:
+                self.samples[j] = value
+
+    def merge(self, state):
+        mine, theirs = self.samples, state["samples"]
+        if len(mine) + len(theirs) <= histogram_reservoir_size:
+            # Neither reservoir has dropped anything yet
+            self.samples = mine + theirs
+        else:
+            # Each side fills the reservoir in proportion to the number of values its samples stand for
+            k = round(histogram_reservoir_size * self.count / (self.count + state["count"]))
+            k = max(histogram_reservoir_size - len(theirs), min(k, len(mine)))
+            self.samples = random.sample(mine, k) + random.sample(theirs, histogram_reservoir_size - k)
+        self.count += state["count"]
+        self.total += state["sum"]
+        self.min = min(self.min, state["min"])
+        self.max = max(self.max, state["max"])
+
+    def state(self):
+        return {"count": self.count, "sum": self.total, "min": self.min, "max": self.max, "samples": list(self.samples)}
+
+    def summary(self):
+        ordered = sorted(self.samples)
+        def pct(q):
+            return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))] if ordered else None
+        return {"count": self.count, "sum": self.total, "mean": self.total / self.count if self.count else None,
+                "min": self.min if self.count else None, "max": self.max if self.count else None,
+                "p50": pct(0.5), "p95": pct(0.95), "p99": pct(0.99)}
+
+
+class JsonlExporter:
+    # Buffered, one JSON record per line; flushed every buffer_size records, every flush_s seconds and at exit
+    def __init__(self, path=default_trace_path, buffer_size=256, flush_s=5.0):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_s = flush_s
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.pid = os.getpid()
+        self.last_flush = time.monotonic()
+
+    def write(self, record):
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked child: the records in the buffer belong to the parent, which flushes them itself
+                self.pid, self.buffer = os.getpid(), []
+            self.buffer.append(record)
+            if len(self.buffer) >= self.buffer_size or time.monotonic() - self.last_flush >= self.flush_s:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                self._flush()
+
+    def _flush(self):
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        path = self.path.format(pid=self.pid)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a") as f:
+            f.writelines(json.dumps(r, default=str) + "\n" for r in self.buffer)
+        self.buffer = []
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_noop_span = _NoopSpan()
+
+
+class Span:
+    __slots__ = ("name", "attrs", "span_id", "parent_id", "wall_start", "start")
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        stack = _span_stack()
+        self.parent_id = stack[-1].span_id if stack else None
+        self.span_id = next(_span_ids)
+        stack.append(self)
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        _span_stack().pop()
+        _record_span(self.name, self.wall_start, duration, self.attrs, self.span_id, self.parent_id,
+                     exc_type.__name__ if exc_type else None)
+        return False
+
+
+def _span_stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _record_span(name, wall_start, duration, attrs, span_id=None, parent_id=None, error=None):
+    observe(f"{name}.duration_s", duration)
+    if error:
+        count(f"{name}.errors")
+    exporter = _exporter
+    if exporter is not None:
+        exporter.write({"type": "span", "name": name, "span_id": span_id, "parent_id": parent_id, "pid": os.getpid(),
+                        "thread": threading.get_ident(), "start": wall_start, "duration_s": duration,
+                        "attrs": attrs, "error": error})
+
+
+def record(name, duration_s, **attrs):
+    # A span measured by the caller (e.g. across the yields of a generator), started duration_s ago
+    if not _enabled:
+        return
+    _record_span(name, time.time() - duration_s, duration_s, attrs)
+
+
+def enable_tracing(path=default_trace_path, exporter=None):
+    # path=None keeps everything in memory (snapshot() / log_to_mlflow() only)
+    global _enabled, _exporter
+    _exporter = exporter or (JsonlExporter(path) if path else None)
+    _enabled = True
+    if _exporter is not None:
+        atexit.register(_exporter.flush)
+
+
+def disable_tracing():
+    global _enabled, _exporter
+    flush()
+    _enabled, _exporter = False, None
+
+
+def is_enabled():
+    return _enabled
+
+
+def span(name, **attrs):
+    # with span("rerank", candidates=len(docs)) as s: ...; s.set(top_score=...)
+    if not _enabled:
+        return _noop_span
+    return Span(name, attrs)
+
+
+def traced(name=None):
+    # Decorator form of span(); the flag is checked on every call so tracing can be switched on later
+    def decorate(fn):
+        span_name = name or fn.__name__
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with Span(span_name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def timed_iter(name, iterable, **attrs):
+    # Time spent producing the items of a lazy iterable (e.g. pages parsed by pdfminer) recorded as one span,
+    # without a record per item
+    if not _enabled:
+        return iterable
+    def timed():
+        iterator, spent, items, wall_start = iter(iterable), 0.0, 0, time.time()
+        stack = _span_stack()
+        parent_id, span_id = (stack[-1].span_id if stack else None), next(_span_ids)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    spent += time.perf_counter() - start
+                    return
+                spent += time.perf_counter() - start
+                items += 1
+                yield item
+        finally:
+            _record_span(name, wall_start, spent, {**attrs, "items": items}, span_id, parent_id)
+    return timed()
+
+
+def count(name, value=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, value):
+    if not _enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(value)
+
+
+def snapshot():
+    with _lock:
+        return {"counters": dict(_counters), "histograms": {k: h.summary() for k, h in _histograms.items()}}
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def drain():
+    # Raw counters / histogram state since the last drain, for shipping to another process (see merge)
+    if not _enabled:
+        return None
+    with _lock:
+        delta = {"counters": dict(_counters), "histograms": {k: h.state() for k, h in _histograms.items()}}
+        _counters.clear()
+        _histograms.clear()
+    return delta
+
+
+def merge(delta):
+    if not delta or not _enabled:
+        return
+    with _lock:
+        for name, value in delta["counters"].items():
+            _counters[name] = _counters.get(name, 0) + value
+        for name, state in delta["histograms"].items():
+            _histograms.setdefault(name, Histogram()).merge(state)
+
+
+def flush():
+    exporter = _exporter
+    if exporter is not None:
+        exporter.write({"type": "metrics", "pid": os.getpid(), "time": time.time(), **snapshot()})
+        exporter.flush()
+
+
+def log_to_mlflow(prefix="", step=None):
+    # Counters as-is, histograms as <name>.<stat> (mean, p50, p95, p99, max, count) on the active MLflow run
+    import mlflow
+    metrics = snapshot()
+    flat = {f"{prefix}{name}": value for name, value in metrics["counters"].items()}
+    for name, summary in metrics["histograms"].items():
+        for stat in ("count", "mean", "p50", "p95", "p99", "max"):
+            if summary[stat] is not None:
+                flat[f"{prefix}{name}.{stat}"] = summary[stat]
+    mlflow.log_metrics(flat, step=step)
+    return flat
+
+
+_env_path = os.environ.get(trace_env_var)
+if _env_path:
+    enable_tracing(default_trace_path if _env_path.lower() in ("1", "true") else _env_path)
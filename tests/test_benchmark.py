@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+from privacy_act_rag import benchmark, resources
+from privacy_act_rag.resources import get_worker_resource, restored_worker_resources, set_worker_resource
+
+
+def test_restored_worker_resources(monkeypatch):
+    monkeypatch.setattr(resources, "_resources", {"deploy_client": "real"})
+    monkeypatch.setattr(resources, "_timings", {"deploy_client": 1.0})
+    with restored_worker_resources():
+        set_worker_resource("deploy_client", "fake")
+        set_worker_resource("embedding_cache", "temporary")
+        assert get_worker_resource("deploy_client", None) == "fake"
+    assert resources._resources == {"deploy_client": "real"}
+    assert resources._timings == {"deploy_client": 1.0}
+
+
+def test_run_benchmark_puts_the_registry_back_and_removes_its_workdir(monkeypatch, tmp_path):
+    # run_benchmark drives the ingest UDF bodies, which import pyspark
+    pytest.importorskip("pyspark")
+    monkeypatch.setattr(resources, "_resources", {"deploy_client": "real", "embedding_cache": "real cache"})
+    workdirs = []
+
+    def mkdtemp(prefix):
+        workdirs.append(str(tmp_path / prefix))
+        os.makedirs(workdirs[-1])
+        return workdirs[-1]
+
+    def stop(*args, **kwargs):
+        # Stop once the stand-ins are registered, without parsing or embedding anything
+        assert get_worker_resource("deploy_client", None) != "real"
+        raise RuntimeError("stop")
+
+    monkeypatch.setattr(benchmark.tempfile, "mkdtemp", mkdtemp)
+    monkeypatch.setattr(benchmark, "make_synthetic_corpus", stop)
+    with pytest.raises(RuntimeError, match="stop"):
+        benchmark.run_benchmark()
+    assert resources._resources == {"deploy_client": "real", "embedding_cache": "real cache"}
+    assert not os.path.exists(workdirs[0])
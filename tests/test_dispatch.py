@@ -0,0 +1,75 @@
+import time
+
+from privacy_act_rag.dispatch import EmbeddingDispatcher, TokenBucket, error_status
+
+
+class EndpointError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status code {status_code}")
+        self.status_code = status_code
+
+
+def dispatcher(**kwargs):
+    return EmbeddingDispatcher("test", max_batch_size=8, max_concurrency=1, backoff_base_s=0.0, **kwargs)
+
+
+def test_error_status():
+    assert error_status(EndpointError(429)) == 429
+    assert error_status(RuntimeError("API request failed with error code 503")) == 503
+    assert error_status(RuntimeError("boom")) is None
+
+
+def test_transient_errors_are_retried():
+    calls = []
+
+    def call(texts):
+        calls.append(texts)
+        if len(calls) < 3:
+            raise TimeoutError()
+        return [[float(len(t))] for t in texts]
+
+    vectors, errors = dispatcher().embed(["a", "bb"], call)
+    assert vectors == [[1.0], [2.0]] and errors == {}
+    assert len(calls) == 3
+
+
+def test_input_errors_are_bisected_down_to_the_bad_input():
+    def call(texts):
+        if any(t.startswith("bad") for t in texts):
+            raise EndpointError(400)
+        return [[0.0] for _ in texts]
+
+    texts = [f"bad{i}" if i in (2, 7) else f"ok{i}" for i in range(8)]
+    vectors, errors = dispatcher().embed(texts, call)
+    assert sorted(errors) == [2, 7]
+    assert all(v is not None for i, v in enumerate(vectors) if i not in errors)
+
+
+def test_count_mismatch_is_bisected():
+    def call(texts):
+        return [[0.0] for t in texts if t != "dropped"]
+
+    vectors, errors = dispatcher().embed(["a", "dropped", "b"], call)
+    assert list(errors) == [1] and vectors[0] == vectors[2] == [0.0]
+
+
+def test_auth_errors_fail_the_batch_without_bisecting():
+    calls = []
+
+    def call(texts):
+        calls.append(texts)
+        raise EndpointError(401)
+
+    vectors, errors = dispatcher(max_retries=2).embed(["a", "b", "c", "d"], call)
+    assert len(calls) == 1
+    assert sorted(errors) == [0, 1, 2, 3] and vectors == [None] * 4
+
+
+def test_token_bucket_charges_oversized_requests_in_full():
+    bucket = TokenBucket(rate=100, capacity=10)
+    bucket.acquire(50)
+    assert bucket.tokens < 0
+    start = time.monotonic()
+    bucket.acquire(1)
+    # 40 tokens of debt plus the one asked for, at 100 per second
+    assert time.monotonic() - start >= 0.35
@@ -0,0 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from privacy_act_rag.embeddings import EmbeddingCache, cached_embeddings, chunk_hash
+
+
+def test_chunk_hash_ignores_whitespace_layout():
+    assert chunk_hash("  a\n\tconsumer   request ") == chunk_hash("a consumer request")
+
+
+def test_cached_embeddings_only_sends_misses_and_skips_failures(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+    sent = []
+
+    def embed(texts):
+        sent.extend(texts)
+        return [None if t == "fails" else [float(len(t))] for t in texts]
+
+    assert cached_embeddings("m", ["ab", "ab", "fails"], embed, cache) == [[2.0], [2.0], None]
+    assert cached_embeddings("m", ["ab", "fails"], embed, cache) == [[2.0], None]
+    assert sent == ["ab", "fails", "fails"]
+
+
+def test_cache_is_shared_by_threads(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+
+    def work(n):
+        texts = [f"chunk {n} {i}" for i in range(50)]
+        return cached_embeddings("m", texts, lambda ts: [[float(n)] for _ in ts], cache)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(work, range(32)))
+    assert all(r == [[float(n)]] * 50 for n, r in enumerate(results))
+    assert len(cache.get_many("m", [chunk_hash(f"chunk 3 {i}") for i in range(50)])) == 50
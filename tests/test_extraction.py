@@ -0,0 +1,98 @@
+import os
+import signal
+import time
+
+import pytest
+
+from privacy_act_rag import extraction, resources
+from privacy_act_rag.extraction import (chunk_document, iter_doc_chunks, iter_doc_sections, make_synthetic_pdf,
+                                        measure_peak_rss, parse_documents)
+
+pytest.importorskip("pdfminer")
+
+
+class Section:
+    def __init__(self, text):
+        self.text = text
+
+
+class FixedSplitter:
+    def split_text(self, txt):
+        return [txt[i:i + 100] for i in range(0, len(txt), 100)]
+
+
+@pytest.fixture
+def partitioner(monkeypatch):
+    calls = []
+
+    def partition(file):
+        calls.append(file)
+        return [Section("ocr text")]
+
+    monkeypatch.setitem(resources._resources, "partitioner", partition)
+    return calls
+
+
+def test_text_pdfs_skip_the_partitioner(partitioner):
+    sections = list(iter_doc_sections(make_synthetic_pdf(num_pages=2, lines_per_page=3)))
+    assert len(sections) == 2 and sections[0].startswith("Section 1.1.")
+    assert partitioner == []
+
+
+def test_pdfs_without_text_fall_back_to_partition(partitioner):
+    assert list(iter_doc_sections(make_synthetic_pdf(num_pages=1, lines_per_page=0))) == ["ocr text"]
+    assert len(partitioner) == 1
+
+
+def test_max_doc_chars_caps_the_text():
+    pdf = make_synthetic_pdf(num_pages=20)
+    assert sum(len(c) for c in iter_doc_chunks(pdf, FixedSplitter(), max_doc_chars=1000)) == 1000
+    assert sum(len(c) for c in chunk_document(pdf, FixedSplitter(), max_doc_chars=250)) == 250
+
+
+def test_measure_peak_rss():
+    assert measure_peak_rss(lambda: bytearray(64 * 1024 * 1024)) > 32
+    with pytest.raises(RuntimeError, match="ZeroDivisionError"):
+        measure_peak_rss(lambda: 1 / 0)
+    with pytest.raises(RuntimeError, match="code 3"):
+        measure_peak_rss(lambda: os._exit(3))
+
+
+def test_deadline_keeps_the_text_read_so_far(monkeypatch):
+    def slow_sections(x):
+        yield "first section. " * 10
+        time.sleep(5)
+        yield "never read"
+
+    monkeypatch.setattr(extraction, "iter_doc_sections", slow_sections)
+    start = time.monotonic()
+    chunks = chunk_document(b"%PDF-1.4 stub", FixedSplitter(), timeout_s=0.2)
+    assert time.monotonic() - start < 2
+    assert "".join(chunks) == "first section. " * 10
+
+
+def test_partition_deadline_falls_back_to_the_raw_text(monkeypatch):
+    def slow_partition(file):
+        time.sleep(5)
+        return [Section("never returned")]
+
+    monkeypatch.setitem(resources._resources, "partitioner", slow_partition)
+    assert chunk_document(b"plain\ntext document", FixedSplitter(), timeout_s=0.2) == ["plain text document"]
+
+
+def test_pool_kills_workers_stuck_past_the_deadline(monkeypatch):
+    def chunk(x, splitter, timeout_s=None, max_doc_chars=None):
+        if x == b"stuck":
+            # Like a parser stuck in C code: the alarm never reaches Python
+            signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGALRM})
+            time.sleep(60)
+        return [x.decode()]
+
+    monkeypatch.setattr(extraction, "get_chunk_splitter", FixedSplitter)
+    monkeypatch.setattr(extraction, "chunk_document", chunk)
+    monkeypatch.setattr(extraction, "parse_kill_grace_s", 0.5)
+    assert parse_documents([b"a", b"bb", b"ccc"], max_workers=2, timeout_s=0.5) == [["a"], ["bb"], ["ccc"]]
+    start = time.monotonic()
+    with pytest.raises(RuntimeError, match=r"documents \[1\]"):
+        parse_documents([b"a", b"stuck", b"b", b"c"], max_workers=2, timeout_s=0.5)
+    assert time.monotonic() - start < 10
@@ -0,0 +1,28 @@
+from privacy_act_rag.generation import merge_overlap, pack_context
+
+
+class WordTokenizer:
+    def encode(self, txt, add_special_tokens=False):
+        return txt.split()
+
+
+def test_merge_overlap():
+    a = "The controller shall respond to a consumer request within forty-five days."
+    b = "respond to a consumer request within forty-five days. The period may be extended once."
+    assert merge_overlap(a, b) == a + " The period may be extended once."
+    assert merge_overlap(a, "Something unrelated that is long enough to compare.") is None
+
+
+def test_pack_context_merges_neighbours_and_keeps_the_budget():
+    first = "one two three four five six seven eight nine ten eleven twelve"
+    second = "seven eight nine ten eleven twelve thirteen fourteen"
+    reranked = [
+        ([1, "CO", "u1", first, 0.9], 0.9),
+        ([2, "CO", "u1", second, 0.8], 0.8),
+        ([3, "CO", "u1", first, 0.7], 0.7),
+        ([4, "TX", "u2", "word " * 50, 0.6], 0.6),
+    ]
+    packed = pack_context(reranked, token_budget=30, tokenizer=WordTokenizer())
+    assert [d[0] for d in packed["docs"]] == [1, 2]
+    assert packed["context"] == "[u1]\n" + first + " thirteen fourteen"
+    assert packed["tokens"] <= 30
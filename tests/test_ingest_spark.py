@@ -0,0 +1,110 @@
+# incremental_ingest end to end and the near-duplicate check, on a local Spark session with Delta, a stub chunker
+# and a stub embedder (no PDFs, no endpoints). Skipped where pyspark, delta-spark or Java is missing.
+import os
+import shutil
+
+import pytest
+
+pyspark = pytest.importorskip("pyspark")
+delta = pytest.importorskip("delta")
+if not (shutil.which("java") or os.environ.get("JAVA_HOME")):
+    pytest.skip("Spark needs Java", allow_module_level=True)
+
+import pandas as pd  # noqa: E402
+from pyspark.sql import SparkSession  # noqa: E402
+from pyspark.sql.functions import pandas_udf  # noqa: E402
+
+from privacy_act_rag.ingest import incremental_ingest, near_duplicate_ids  # noqa: E402
+
+colorado = "dbfs:/Volumes/demo/hackathon/pdfs/Colorado/act.pdf"
+texas = "dbfs:/Volumes/demo/hackathon/pdfs/Texas/act.pdf"
+
+
+@pandas_udf("array<string>")
+def split_paragraphs(contents: pd.Series) -> pd.Series:
+    return pd.Series([bytes(c).decode("utf-8").split("\n\n") for c in contents])
+
+
+@pandas_udf("embedding array<float>, error string")
+def stub_embedding(contents: pd.Series) -> pd.DataFrame:
+    failed = ["FAIL" in c for c in contents]
+    return pd.DataFrame({"embedding": [None if f else [float(len(c)), 1.0] for c, f in zip(contents, failed)],
+                         "error": ["rejected" if f else None for f in failed]})
+
+
+@pytest.fixture(scope="module")
+def spark(tmp_path_factory):
+    warehouse = tmp_path_factory.mktemp("warehouse")
+    builder = (SparkSession.builder.master("local[2]")
+               .config("spark.sql.warehouse.dir", str(warehouse))
+               .config("spark.sql.shuffle.partitions", "2")
+               .config("spark.sql.sources.default", "delta")
+               .config("spark.sql.extensions", "io.delta.sql.DeltaSparkSessionExtension")
+               .config("spark.sql.catalog.spark_catalog", "org.apache.spark.sql.delta.catalog.DeltaCatalog"))
+    session = delta.configure_spark_with_delta_pip(builder).getOrCreate()
+    yield session
+    session.stop()
+
+
+def write_raw(spark, docs):
+    (spark.createDataFrame([(path, text.encode("utf-8")) for path, text in docs.items()], "path STRING, content BINARY")
+        .write.mode("overwrite").saveAsTable("raw_docs"))
+
+
+def ingest(spark):
+    return incremental_ingest("chunks", "embedding", "stub-model", stub_embedding, raw_table="raw_docs",
+                              state_table="ingest_state", chunker=split_paragraphs, spark=spark,
+                              cache_table="stub_embedding_cache", error_table="stub_embedding_errors")
+
+
+def contents(spark, url):
+    return sorted(r.content for r in spark.table("chunks").where(f"url = '{url}'").collect())
+
+
+def test_failed_document_stays_at_previous_version(spark):
+    write_raw(spark, {
+        colorado: "A controller shall provide notice of processing.\n\nConsumers may opt out of targeted advertising.",
+        texas: "Biometric identifiers require consent before capture.\n\nA processor assists the controller.",
+    })
+    assert ingest(spark) == {"changed_docs": 2, "removed_docs": 0, "failed_docs": 0}
+    before = contents(spark, colorado)
+    assert len(before) == 2 and len(contents(spark, texas)) == 2
+    # The cache table is the one passed in, not the shared demo.hackathon one
+    assert spark.table("stub_embedding_cache").count() == 4
+
+    write_raw(spark, {
+        colorado: "A controller shall provide notice of processing.\n\nData brokers must register annually.\n\nFAIL here",
+        texas: "Biometric identifiers require consent before capture.\n\nSensitive data needs a risk assessment.",
+    })
+    assert ingest(spark) == {"changed_docs": 2, "removed_docs": 0, "failed_docs": 1}
+    # The Colorado document failed: none of its new chunks went in and its old ones are all still there
+    assert contents(spark, colorado) == before
+    assert contents(spark, texas) == ["Biometric identifiers require consent before capture.",
+                                      "Sensitive data needs a risk assessment."]
+    assert [r.error for r in spark.table("stub_embedding_errors").collect()] == ["rejected"]
+    states = {r.path: r.doc_hash for r in spark.table("ingest_state").collect()}
+    assert set(states) == {colorado, texas}
+
+    # Fixed on the next run, which picks the document up again
+    write_raw(spark, {
+        colorado: "A controller shall provide notice of processing.\n\nData brokers must register annually.",
+        texas: "Biometric identifiers require consent before capture.\n\nSensitive data needs a risk assessment.",
+    })
+    assert ingest(spark) == {"changed_docs": 1, "removed_docs": 0, "failed_docs": 0}
+    assert contents(spark, colorado) == ["A controller shall provide notice of processing.",
+                                         "Data brokers must register annually."]
+    # Nothing a run persisted stays cached on the cluster
+    assert spark._jsparkSession.sharedState().cacheManager().isEmpty()
+
+
+def test_near_duplicates_are_only_dropped_within_a_state(spark):
+    model_text = ("A consumer has the right to opt out of the processing of personal data for purposes of targeted "
+                  "advertising, the sale of personal data or profiling in furtherance of decisions that produce legal "
+                  "or similarly significant effects concerning the consumer.")
+    chunks = spark.createDataFrame([(1, "Colorado", model_text), (2, "Virginia", model_text),
+                                    (3, "Virginia", model_text + " Virginia."), (4, "Texas", "Unrelated text.")],
+                                   "id BIGINT, state STRING, content STRING")
+    assert [r.id for r in near_duplicate_ids(chunks).collect()] == [3]
+
+    reference = spark.createDataFrame([(9, "Texas", model_text)], "id BIGINT, state STRING, content STRING")
+    assert near_duplicate_ids(chunks.where("id = 1"), reference).count() == 0
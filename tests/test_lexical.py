@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+
+from privacy_act_rag.lexical import BM25Index, decode_varints, encode_varints, tokenize
+
+
+def test_varint_round_trip():
+    values = [0, 1, 127, 128, 300, 16383, 16384, 2 ** 40]
+    encoded, sizes = encode_varints(values)
+    assert sizes.tolist() == [1, 1, 1, 2, 2, 2, 3, 6]
+    assert len(encoded) == sizes.sum()
+    assert decode_varints(encoded).tolist() == values
+    assert decode_varints(np.empty(0, dtype=np.uint8)).tolist() == []
+
+
+def test_tokenize_keeps_citations():
+    assert tokenize("See Section 1798.140 and C.R.S. 6-1-1303 for the data") == [
+        "see", "section", "1798.140", "c.r.s", "6-1-1303", "data"]
+
+
+def sample_index():
+    return BM25Index.from_pandas(pd.DataFrame({
+        "id": [1, 2, 3, 4], "state": ["CO", "CO", "TX", "TX"], "url": ["a", "b", "c", "d"],
+        "content": ["biometric data of a consumer", "controller duties", "biometric identifiers", "a processor"]}))
+
+
+def test_bm25_search_respects_state_partitions(tmp_path):
+    index = sample_index()
+    rows = index.similarity_search(columns=["id"], filters={"state": "TX"}, query_text="biometric")["result"]["data_array"]
+    assert [r[0] for r in rows] == [3]
+    rows = index.similarity_search(columns=["id"], query_text="biometric consumer")["result"]["data_array"]
+    assert [r[0] for r in rows] == [1, 3]
+
+    index.save(tmp_path)
+    loaded = BM25Index.load(tmp_path)
+    assert loaded.similarity_search(columns=["id"], query_text="controller")["result"]["data_array"][0][0] == 2
+    assert loaded.nbytes()["postings_bytes"] < loaded.nbytes()["int32_postings_bytes"]
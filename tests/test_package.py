@@ -0,0 +1,23 @@
+import importlib
+import subprocess
+import sys
+
+import pytest
+
+# rerank (torch / transformers) and ingest (pyspark) are the modules that hold the heavy imports; the others
+# import them lazily
+modules = ["answer_cache", "batch", "dedup", "dispatch", "embeddings", "extraction", "generation", "lexical",
+           "pipeline", "quantization", "resources", "retrieval", "server", "states", "tracing"]
+
+
+@pytest.mark.parametrize("name", modules)
+def test_modules_import_without_the_heavy_dependencies(name):
+    importlib.import_module(f"privacy_act_rag.{name}")
+
+
+def test_importing_the_pipeline_loads_no_models():
+    # torch / transformers / the unstructured stack are only imported by the first query or document that needs them
+    code = ("import sys, privacy_act_rag.pipeline, privacy_act_rag.server; "
+            "print(sorted(m for m in ('torch', 'transformers', 'unstructured', 'llama_index') if m in sys.modules))")
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    assert out.strip() == "[]"
@@ -0,0 +1,43 @@
+import pytest
+
+from privacy_act_rag.answer_cache import SemanticAnswerCache
+from privacy_act_rag.pipeline import PrivacyActRAG, RAGConfig
+
+
+def cached_rag():
+    rag = PrivacyActRAG(RAGConfig(indexed_states=["Colorado"], use_lexical_index=False))
+    cache = SemanticAnswerCache()
+    cache.put([1.0, 0.0], {"state": ["Colorado"]},
+              {"query": "Colorado privacy act start date", "answer": "July 1, 2023", "filters": {"state": ["Colorado"]},
+               "docs": [], "context_tokens": 0}, 2.0)
+    rag.components["answer_cache"] = cache
+    rag.embed_bge = lambda query: [1.0, 0.0]
+    rag.embed_queries = lambda queries: ({"bge": [[1.0, 0.0]] * len(queries), "ada": [None] * len(queries)}, {})
+    return rag
+
+
+def test_cache_hits_report_the_asked_query():
+    rag = cached_rag()
+    result = rag.answer("when does the Colorado act take effect")
+    assert result["cached"] and result["answer"] == "July 1, 2023"
+    assert result["query"] == "when does the Colorado act take effect"
+
+    results = rag.answer_batch(["Colorado effective date", "start of the Colorado act"])
+    assert [r["query"] for r in results] == ["Colorado effective date", "start of the Colorado act"]
+    assert all(r["cached"] for r in results)
+
+
+def test_cache_miss_reuses_the_lookup_vector_for_retrieval():
+    rag = cached_rag()
+    rag.answer_cache.entries.clear()
+    calls = {}
+
+    class Retriever:
+        def retrieve(self, query, filters=None, num_results=None, query_vectors=None):
+            calls["query_vectors"] = query_vectors
+            raise RuntimeError("stop after retrieval")
+
+    rag.components["retriever"] = Retriever()
+    with pytest.raises(RuntimeError, match="stop after retrieval"):
+        rag.answer("when does the Colorado act take effect")
+    assert calls["query_vectors"] == {"bge": [1.0, 0.0]}
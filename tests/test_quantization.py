@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+from privacy_act_rag.quantization import decode_vectors, dequantize_vectors, encode_vectors, quantize_vectors
+
+
+@pytest.mark.parametrize("dtype, tolerance", [("int8", 1e-2), ("float16", 1e-3)])
+def test_round_trip(dtype, tolerance):
+    mat = np.random.default_rng(0).normal(size=(5, 64)).astype(np.float32)
+    codes, scales = quantize_vectors(mat, dtype)
+    assert np.abs(dequantize_vectors(codes, scales) - mat).max() < tolerance * np.abs(mat).max()
+
+    blobs = encode_vectors([mat[0], None, mat[1]], dtype)
+    assert blobs[1] is None
+    codes, scales = decode_vectors([blobs[0], blobs[2]], dtype)
+    assert np.allclose(dequantize_vectors(codes, scales), mat[:2], atol=tolerance * np.abs(mat).max())
+
+
+def test_zero_vector_and_bad_dtype():
+    codes, scales = quantize_vectors(np.zeros((1, 4)))
+    assert not codes.any() and scales[0] == 1
+    with pytest.raises(ValueError):
+        quantize_vectors(np.ones((1, 4)), "int4")
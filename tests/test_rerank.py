@@ -0,0 +1,24 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from privacy_act_rag.rerank import BGEReranker  # noqa: E402
+
+
+def test_single_candidates_are_scored(monkeypatch):
+    reranker = BGEReranker()
+    scored_pairs = []
+
+    def score_pairs(pairs):
+        scored_pairs.extend(pairs)
+        return [float(len(p)) for _, p in pairs]
+
+    monkeypatch.setattr(reranker, "score_pairs", score_pairs)
+    results = reranker.rerank_many(["q1", "q2"], [[[1, "CO", "u", "abc"]], [[2, "CO", "u", "a"], [3, "CO", "u", "ab"]]])
+    assert results[0] == [([1, "CO", "u", "abc"], 3.0)]
+    assert [score for _, score in results[1]] == [2.0, 1.0]
+    assert len(scored_pairs) == 3
+    # Cached afterwards
+    assert reranker.rerank("q1", [[1, "CO", "u", "abc"]]) == [([1, "CO", "u", "abc"], 3.0)]
+    assert len(scored_pairs) == 3
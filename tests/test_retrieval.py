@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+
+from privacy_act_rag.retrieval import LocalVectorIndex, reciprocal_rank_fusion
+
+
+def test_reciprocal_rank_fusion():
+    bge = [[1, "CO", "a", "x", 0.9], [2, "CO", "b", "y", 0.8]]
+    ada = [[2, "CO", "b", "y", 0.7], [3, "CO", "c", "z", 0.6]]
+    fused = reciprocal_rank_fusion([bge, ada], k=60)
+    assert [r[0] for r in fused] == [2, 1, 3]
+    assert fused[0][:4] == [2, "CO", "b", "y"]
+    assert np.isclose(fused[0][4], 1 / 62 + 1 / 61)
+    assert np.isclose(fused[1][4], 1 / 61)
+
+
+def test_local_index_filters_and_ranks():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"id": range(6), "state": ["CO", "CO", "CO", "TX", "TX", "TX"],
+                       "url": [f"u{i}" for i in range(6)], "content": [f"c{i}" for i in range(6)],
+                       "embedding": list(rng.normal(size=(6, 8)).astype(np.float32))})
+    index = LocalVectorIndex.from_pandas(df, "embedding")
+    q = df["embedding"][4]
+    rows = index.similarity_search(q, ["id", "state"], filters={"state": "TX"}, num_results=2)["result"]["data_array"]
+    assert rows[0][:2] == [4, "TX"]
+    assert len(rows) == 2 and all(r[1] == "TX" for r in rows)
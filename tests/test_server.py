@@ -0,0 +1,61 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from privacy_act_rag.server import make_handler
+
+
+class StubRAG:
+    def answer(self, query):
+        if query == "explode":
+            raise KeyError("missing component")
+        return {"query": query, "answer": "yes"}
+
+    def answer_batch(self, queries):
+        return [self.answer(q) for q in queries]
+
+    def metrics(self):
+        return {"queries": 0}
+
+
+@pytest.fixture(scope="module")
+def url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(StubRAG()))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=body if isinstance(body, bytes) else json.dumps(body).encode())
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_answer(url):
+    status, body = post(url + "/answer", {"query": "does Colorado have a privacy act"})
+    assert status == 200 and body["result"]["answer"] == "yes"
+    status, body = post(url + "/answer_batch", {"queries": ["a", "b"]})
+    assert status == 200 and [r["query"] for r in body["result"]] == ["a", "b"]
+
+
+@pytest.mark.parametrize("path, body", [
+    ("/answer", b"not json"), ("/answer", {}), ("/answer", {"query": 3}), ("/answer", ["query"]),
+    ("/answer_batch", {"queries": "one query"}), ("/answer_batch", {"queries": [1, 2]}),
+])
+def test_malformed_requests_are_400(url, path, body):
+    assert post(url + path, body)[0] == 400
+
+
+def test_pipeline_errors_are_500(url):
+    status, body = post(url + "/answer", {"query": "explode"})
+    assert status == 500 and "missing component" in body["error"]
+    assert post(url + "/nowhere", {})[0] == 404
@@ -0,0 +1,54 @@
+from privacy_act_rag.states import (canonical_state, detect_state_filters, match_states, parse_state_response,
+                                    resolve_indexed_states)
+
+
+def test_names_and_codes():
+    assert match_states("Does the Colorado act cover biometric data?") == ({"Colorado"}, False)
+    assert match_states("compare NY and TX") == ({"New York", "Texas"}, False)
+    assert match_states("rules in west  virginia") == ({"West Virginia"}, False)
+    assert match_states("Washington D.C. rules") == ({"District of Columbia"}, False)
+
+
+def test_ambiguous_codes_are_not_trusted():
+    assert match_states("what is OK to collect") == (set(), True)
+    assert match_states("WHAT DOES TEXAS SAY") == ({"Texas"}, False)
+    assert match_states("DOES NY HAVE A LAW") == (set(), True)
+
+
+def test_short_aliases_need_a_capital_and_a_second_opinion():
+    assert match_states("mass surveillance rules") == (set(), False)
+    assert match_states("Can I wash my data?") == (set(), False)
+    assert match_states("is a penn and paper form enough") == (set(), False)
+    assert match_states("the Mass privacy bill") == (set(), True)
+
+
+def test_detect_state_filters_asks_the_llm_only_when_ambiguous():
+    calls = []
+
+    def llm(query):
+        calls.append(query)
+        return 'Sure: {"state": ["Massachusetts"]}'
+
+    indexed = ["Colorado", "Massachusetts", "New_York"]
+    assert detect_state_filters("mass surveillance in New York", indexed, llm) == {"state": ["New_York"]}
+    assert calls == []
+    assert detect_state_filters("the Mass privacy bill", indexed, llm) == {"state": ["Massachusetts"]}
+    assert calls == ["the Mass privacy bill"]
+
+
+def test_helpers():
+    assert canonical_state("mass") == "Massachusetts"
+    assert canonical_state(" co ") == "Colorado"
+    assert canonical_state("Atlantis") is None
+    assert parse_state_response("{'state': 'Texas'}") == ["Texas"]
+    assert parse_state_response("no idea") == []
+    assert resolve_indexed_states({"New York", "Ohio"}, ["new-york", "Texas"]) == ["new-york"]
+
+
+def test_failing_llm_fallback_keeps_the_unambiguous_matches():
+    def llm(query):
+        raise TimeoutError("chat endpoint timed out")
+
+    indexed = ["Colorado", "Oklahoma"]
+    assert detect_state_filters("is it OK in Colorado", indexed, llm) == {"state": ["Colorado"]}
+    assert detect_state_filters("is it OK here", indexed, llm) == {"state": []}
@@ -0,0 +1,32 @@
+from privacy_act_rag.tracing import Histogram, histogram_reservoir_size
+
+
+def test_histogram_summary():
+    h = Histogram()
+    for v in range(1, 101):
+        h.add(float(v))
+    s = h.summary()
+    assert (s["count"], s["min"], s["max"], s["mean"]) == (100, 1.0, 100.0, 50.5)
+    assert 49 <= s["p50"] <= 52
+
+
+def test_merge_weights_reservoirs_by_count():
+    busy, quiet = Histogram(), Histogram()
+    for _ in range(50 * histogram_reservoir_size):
+        busy.add(0.0)
+    for _ in range(histogram_reservoir_size):
+        quiet.add(1.0)
+    # Merging the small histogram last must not let its samples take over the percentiles
+    busy.merge(quiet.state())
+    assert busy.count == 51 * histogram_reservoir_size
+    assert len(busy.samples) == histogram_reservoir_size
+    assert sum(busy.samples) < 0.05 * histogram_reservoir_size
+    assert busy.summary()["p95"] == 0.0
+
+
+def test_merge_keeps_everything_while_it_fits():
+    a, b = Histogram(), Histogram()
+    a.add(1.0)
+    b.add(2.0)
+    a.merge(b.state())
+    assert sorted(a.samples) == [1.0, 2.0] and a.summary()["max"] == 2.0